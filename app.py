@@ -1,5 +1,6 @@
-from flask import Flask, render_template, jsonify, request, session, redirect, url_for, g
+from flask import Flask, render_template, jsonify, request, session, redirect, url_for, g, has_request_context
 from yandex_music import Client
+from yandex_music.exceptions import UnauthorizedError
 import sqlite3
 import os
 import json
@@ -13,17 +14,29 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import base64
+import calendar
 from PIL import Image
 from io import BytesIO
 import requests
 import vk_api
+from vk_api.vk_api import DEFAULT_USERAGENT
 import re
+from urllib.parse import urlparse, parse_qs
 import secrets
 import random
-from collections import Counter
+import hashlib
+import threading
+import queue
+import atexit
+from collections import Counter, OrderedDict, namedtuple
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_caching import Cache
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from config import Config
 from models import db, User, UserCurrency, ShopCategory, ShopItem, UserInventory, CurrencyTransaction
 
 
@@ -39,11 +52,42 @@ limiter = Limiter(app)
 limiter.key_func = get_remote_address
 cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 300})
 
-# Конфигурация базы данных
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///itired.db'
+# Конфигурация базы данных: один пул соединений и для моделей, и для запросов через get_db().
+# Без DATABASE_URL используется файл SQLite в instance/
+DATABASE = os.path.join(app.instance_path, 'itired.db')
+os.makedirs(app.instance_path, exist_ok=True)
+app.config['SQLALCHEMY_DATABASE_URI'] = Config.DATABASE_URL or f'sqlite:///{DATABASE}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': Config.DB_POOL_SIZE,
+    'max_overflow': Config.DB_MAX_OVERFLOW,
+    'pool_recycle': Config.DB_POOL_RECYCLE,
+    'pool_timeout': Config.DB_POOL_TIMEOUT,
+    'pool_pre_ping': True
+}
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'timeout': Config.DB_POOL_TIMEOUT}
 db.init_app(app)
 
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 15000
+}
+
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
+with app.app_context():
+    IS_SQLITE = db.engine.dialect.name == 'sqlite'
+    if IS_SQLITE:
+        event.listen(db.engine, 'connect', configure_sqlite_connection)
+
 # Инициализация базы данных
 def init_database():
     try:
@@ -53,6 +97,8 @@ def init_database():
             
             init_db() 
             
+            apply_schema_migrations(get_db())
+            
             init_shop_data()
             create_admin_user()
             logger.info("Database initialized successfully")
@@ -153,8 +199,17 @@ def can_afford_item(user_id, item_price):
     balance = get_user_currency_balance(user_id)
     return balance >= item_price
 
-def get_equipped_items(user_id):
-    inventory = UserInventory.query.filter_by(
+# Надетые предметы запрашиваются на каждом открытии профиля; кеш сбрасывается при покупке и смене предметов,
+# но только в своем процессе — на других воркерах старый набор живет до истечения TTL, поэтому он короткий
+EQUIPPED_CACHE_TTL = 5
+
+def load_equipped_items(user_id):
+    """Надетые предметы пользователя по типу предмета"""
+    equipped_items = cache.get(f'equipped_{user_id}')
+    if equipped_items is not None:
+        return equipped_items
+    
+    inventory = UserInventory.query.options(db.joinedload(UserInventory.item)).filter_by(
         user_id=user_id, equipped=True
     ).all()
     
@@ -162,11 +217,26 @@ def get_equipped_items(user_id):
     for inv_item in inventory:
         equipped_items[inv_item.item.type] = {
             'item_id': inv_item.item_id,
-            'data': json.loads(inv_item.item.data) if inv_item.item.data else {}
+            'name': inv_item.item.name,
+            'type': inv_item.item.type,
+            'data': inv_item.item.get_data_dict(),
+            'purchased_at': inv_item.purchased_at.isoformat() if inv_item.purchased_at else None
         }
     
+    cache.set(f'equipped_{user_id}', equipped_items, timeout=EQUIPPED_CACHE_TTL)
     return equipped_items
 
+def forget_equipped_items(user_id):
+    cache.delete(f'equipped_{user_id}')
+
+def unequip_items(user_id, item_type):
+    """Снять все предметы типа одним UPDATE; коммит на вызывающем"""
+    UserInventory.query.filter(
+        UserInventory.user_id == user_id,
+        UserInventory.equipped == True,
+        UserInventory.item_id.in_(db.select(ShopItem.id).where(ShopItem.type == item_type))
+    ).update({'equipped': False}, synchronize_session=False)
+
 def create_admin_user():
     try:
         admin_user = User.query.filter_by(username='admin').first()
@@ -183,11 +253,124 @@ def create_admin_user():
     except Exception as e:
         logger.error(f"Error creating admin user: {e}")
 
+# Журнал валюты: UserCurrency.balance — основной источник баланса, currency_transactions —
+# история для аудита. Мелкие награды пишутся одной строкой на пачку, а старые строки
+# сворачиваются в одну на пользователя, причину и день; entries хранит, сколько начислений в строке
+LEDGER_MICRO_REASONS = ('listen_track',)
+LEDGER_COMPACT_AFTER_DAYS = 30
+
+def compact_currency_ledger(before=None):
+    """Свернуть строки мелких наград старше before в суточные итоги.
+    
+    Сумма по пользователю не меняется. Возвращает (удалено строк, создано итоговых).
+    """
+    if before is None:
+        before = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=LEDGER_COMPACT_AFTER_DAYS)
+    
+    old_rows = (
+        CurrencyTransaction.reason.in_(LEDGER_MICRO_REASONS),
+        CurrencyTransaction.created_at < before
+    )
+    user_ids = [
+        user_id for (user_id,) in
+        db.session.query(CurrencyTransaction.user_id).filter(*old_rows).distinct()
+    ]
+    
+    removed = created = 0
+    for user_id in user_ids:
+        groups = {}
+        for row_id, reason, amount, entries, created_at in db.session.query(
+            CurrencyTransaction.id, CurrencyTransaction.reason, CurrencyTransaction.amount,
+            CurrencyTransaction.entries, CurrencyTransaction.created_at
+        ).filter(CurrencyTransaction.user_id == user_id, *old_rows):
+            day = datetime.combine(created_at.date(), datetime.min.time())
+            group = groups.setdefault((reason, day), {'ids': [], 'amount': 0, 'entries': 0})
+            group['ids'].append(row_id)
+            group['amount'] += amount
+            group['entries'] += entries or 1
+        
+        # Одна транзакция на пользователя, чтобы не держать блокировку записи долго
+        for (reason, day), group in groups.items():
+            if len(group['ids']) < 2:
+                continue
+            CurrencyTransaction.query.filter(CurrencyTransaction.id.in_(group['ids'])).delete(synchronize_session=False)
+            db.session.add(CurrencyTransaction(
+                user_id=user_id,
+                amount=group['amount'],
+                reason=reason,
+                entries=group['entries'],
+                created_at=day
+            ))
+            removed += len(group['ids'])
+            created += 1
+        db.session.commit()
+    
+    return removed, created
+
+def currency_ledger_drift(user_ids=None):
+    """Подзапрос (user_id, balance, ledger) по пользователям, у которых баланс не сходится с журналом.
+    
+    Балансы и журнал агрегируются в одном запросе, чтобы обе суммы были из одного снимка базы.
+    """
+    rows = db.union_all(
+        db.select(
+            UserCurrency.user_id,
+            db.func.coalesce(UserCurrency.balance, 0).label('balance'),
+            db.literal(0).label('ledger')
+        ),
+        db.select(CurrencyTransaction.user_id, db.literal(0), CurrencyTransaction.amount)
+    ).subquery()
+    balance = db.func.sum(rows.c.balance)
+    ledger = db.func.sum(rows.c.ledger)
+    query = db.select(
+        rows.c.user_id, balance.label('balance'), ledger.label('ledger')
+    ).group_by(rows.c.user_id).having(balance != ledger)
+    if user_ids is not None:
+        query = query.where(rows.c.user_id.in_(user_ids))
+    return query.subquery()
+
+def reconcile_currency_ledger(fix=False):
+    """Сверить балансы с суммой по журналу; возвращает расхождения.
+    
+    При fix=True в журнал пишется корректирующая строка — баланс остается как есть.
+    """
+    drift = currency_ledger_drift()
+    mismatches = [
+        {'user_id': user_id, 'balance': balance, 'ledger': ledger}
+        for user_id, balance, ledger in db.session.execute(db.select(drift).order_by(drift.c.user_id))
+    ]
+    
+    if fix and mismatches:
+        # Между чтением и записью баланс мог измениться (покупка, награды), поэтому
+        # расхождение пересчитывается в самом INSERT ... SELECT: SQLite выполняет его
+        # под блокировкой записи, и пользователи, у которых расхождение ушло, пропускаются
+        drift = currency_ledger_drift([mismatch['user_id'] for mismatch in mismatches])
+        adjusted = dict(db.session.execute(
+            db.insert(CurrencyTransaction).from_select(
+                ['user_id', 'amount', 'reason', 'entries', 'created_at'],
+                db.select(
+                    drift.c.user_id,
+                    drift.c.balance - drift.c.ledger,
+                    db.literal('ledger_adjustment'),
+                    db.literal(1),
+                    db.literal(datetime.utcnow())
+                )
+            ).returning(CurrencyTransaction.user_id, CurrencyTransaction.amount)
+        ).all())
+        db.session.commit()
+        mismatches = [
+            {**mismatch, 'adjustment': adjusted[mismatch['user_id']]}
+            for mismatch in mismatches if mismatch['user_id'] in adjusted
+        ]
+        logger.warning(f"Ledger reconciliation: adjusted {len(mismatches)} users")
+    
+    return mismatches
+
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         user = get_current_user()
-        if not user or not user[10]: 
+        if not user or not user.is_admin: 
             return jsonify({'error': 'Требуются права администратора'}), 403
         return f(*args, **kwargs)
     return decorated_function
@@ -200,15 +383,24 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def credit_currency(user_id, amount):
+    """Начислить валюту в текущей транзакции, без коммита.
+    
+    Баланс увеличивается условным UPDATE в базе, а не через прочитанный объект, поэтому
+    параллельные начисления и покупки не затирают друг друга. Строка баланса создается,
+    только если UPDATE ничего не обновил.
+    """
+    updated = db.session.execute(
+        db.update(UserCurrency)
+        .where(UserCurrency.user_id == user_id)
+        .values(balance=UserCurrency.balance + amount, updated_at=datetime.utcnow())
+    ).rowcount
+    if not updated:
+        db.session.add(UserCurrency(user_id=user_id, balance=amount))
+
 def add_currency(user_id, amount, reason):
     try:
-        currency = UserCurrency.query.filter_by(user_id=user_id).first()
-        
-        if currency:
-            currency.balance += amount
-        else:
-            currency = UserCurrency(user_id=user_id, balance=amount)
-            db.session.add(currency)
+        credit_currency(user_id, amount)
         
         transaction = CurrencyTransaction(
             user_id=user_id,
@@ -224,7 +416,6 @@ def add_currency(user_id, amount, reason):
         db.session.rollback()
         return False
 
-DATABASE = 'itired.db'
 UPLOAD_FOLDER = 'static/uploads/avatars'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
@@ -238,33 +429,37 @@ EMAIL_CONFIG = {
 def adapt_datetime(dt):
     return dt.isoformat()
 
-def convert_datetime(text):
-    return datetime.fromisoformat(text.decode())
-
 sqlite3.register_adapter(datetime, adapt_datetime)
-sqlite3.register_converter("datetime", convert_datetime)
 
 def get_db():
-    db = getattr(g, '_database', None)
-    if db is None:
-        db = g._database = sqlite3.connect(DATABASE, detect_types=sqlite3.PARSE_DECLTYPES)
-    return db
+    """Соединение SQLAlchemy из общего пула на время контекста приложения.
+    
+    Запросы идут через db.text() с именованными параметрами, поэтому работают и в SQLite,
+    и в PostgreSQL. Даты из SQLite приходят строками, из PostgreSQL — объектами datetime.
+    """
+    conn = getattr(g, '_database', None)
+    if conn is None:
+        conn = g._database = db.engine.connect()
+    return conn
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
-        db.close()
+    conn = g.pop('_database', None)
+    if conn is not None:
+        conn.close()
+
+# Автоинкрементный ключ таблиц init_db: в SQLite — AUTOINCREMENT (счетчик в sqlite_sequence),
+# в PostgreSQL — IDENTITY; BY DEFAULT разрешает вставку с явным id при миграции
+ID_COLUMN = 'id INTEGER PRIMARY KEY AUTOINCREMENT' if IS_SQLITE else 'id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY'
 
 def init_db():
     with app.app_context():
-        db = get_db()
-        cursor = db.cursor()
+        conn = get_db()
         
         # Таблица пользователей
-        cursor.execute('''
+        conn.execute(db.text(f'''
             CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {ID_COLUMN},
                 username TEXT UNIQUE NOT NULL,
                 display_name TEXT,
                 email TEXT UNIQUE,
@@ -275,14 +470,15 @@ def init_db():
                 bio TEXT,
                 email_verified BOOLEAN DEFAULT FALSE,
                 verification_code TEXT,
-                verification_code_expires DATETIME,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                verification_code_expires TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_admin BOOLEAN DEFAULT FALSE
             )
-        ''')
+        '''))
         
         # Таблица настроек
-        cursor.execute('''
+        conn.execute(db.text('''
             CREATE TABLE IF NOT EXISTS user_settings (
                 user_id INTEGER PRIMARY KEY,
                 theme TEXT DEFAULT 'dark',
@@ -292,132 +488,1020 @@ def init_db():
                 music_service TEXT DEFAULT 'yandex',
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
-        ''')
+        '''))
         
         # Таблица активности пользователя
-        cursor.execute('''
+        conn.execute(db.text(f'''
             CREATE TABLE IF NOT EXISTS user_activity (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {ID_COLUMN},
                 user_id INTEGER,
                 activity_type TEXT NOT NULL,
                 activity_data TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
-        ''')
+        '''))
         
         # Таблица друзей
-        cursor.execute('''
+        conn.execute(db.text(f'''
             CREATE TABLE IF NOT EXISTS friends (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {ID_COLUMN},
                 user_id INTEGER,
                 friend_id INTEGER,
                 status TEXT DEFAULT 'pending',
                 taste_match INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id),
                 FOREIGN KEY (friend_id) REFERENCES users (id),
                 UNIQUE(user_id, friend_id)
             )
-        ''')
+        '''))
         
-        # Таблица для хранения истории прослушивания
-        cursor.execute('''
+        # Старая история прослушивания; новые записи идут в play_events, перенос — migrate_database.py
+        conn.execute(db.text(f'''
             CREATE TABLE IF NOT EXISTS listening_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {ID_COLUMN},
                 user_id INTEGER,
                 track_id TEXT,
                 track_data TEXT,
-                played_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                played_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
-        ''')
+        '''))
+        
+        # Справочник треков: одна строка на трек вместо копии JSON в каждом прослушивании
+        conn.execute(db.text(f'''
+            CREATE TABLE IF NOT EXISTS tracks (
+                {ID_COLUMN},
+                track_key TEXT UNIQUE NOT NULL,
+                title TEXT,
+                artists TEXT,
+                album TEXT,
+                genre TEXT,
+                duration INTEGER,
+                cover_uri TEXT
+            )
+        '''))
+        
+        # Прослушивания: только числовые id и время в epoch
+        conn.execute(db.text(f'''
+            CREATE TABLE IF NOT EXISTS play_events (
+                {ID_COLUMN},
+                user_id INTEGER NOT NULL,
+                track_id INTEGER NOT NULL,
+                played_at INTEGER NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users (id),
+                FOREIGN KEY (track_id) REFERENCES tracks (id)
+            )
+        '''))
+        
+        conn.execute(db.text('''
+            CREATE INDEX IF NOT EXISTS idx_play_events_user_played
+            ON play_events (user_id, played_at)
+        '''))
+        
+        # migrate_database.py переносит listening_history в play_events с теми же id,
+        # поэтому новые события нумеруются после последней старой записи
+        if IS_SQLITE:
+            conn.execute(db.text('''
+                INSERT INTO sqlite_sequence (name, seq)
+                SELECT 'play_events', MAX(id) FROM listening_history
+                WHERE NOT EXISTS (SELECT 1 FROM play_events)
+                    AND NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'play_events')
+                HAVING MAX(id) IS NOT NULL
+            '''))
+        else:
+            conn.execute(db.text('''
+                SELECT setval(pg_get_serial_sequence('play_events', 'id'), MAX(id)) FROM listening_history
+                HAVING MAX(id) IS NOT NULL AND NOT EXISTS (SELECT 1 FROM play_events)
+            '''))
+
+        # Локальное зеркало медиатеки пользователя
+        conn.execute(db.text('''
+            CREATE TABLE IF NOT EXISTS library_sync (
+                user_id INTEGER,
+                service TEXT NOT NULL,
+                resource TEXT NOT NULL,
+                revision INTEGER,
+                synced_at INTEGER,
+                PRIMARY KEY (user_id, service, resource),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        '''))
+
+        conn.execute(db.text('''
+            CREATE TABLE IF NOT EXISTS library_tracks (
+                user_id INTEGER,
+                track_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                track_data TEXT,
+                PRIMARY KEY (user_id, track_id),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        '''))
+
+        conn.execute(db.text('''
+            CREATE TABLE IF NOT EXISTS library_playlists (
+                user_id INTEGER,
+                playlist_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                revision INTEGER,
+                collective BOOLEAN DEFAULT FALSE,
+                playlist_data TEXT,
+                PRIMARY KEY (user_id, playlist_id),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        '''))
+        
+        # Статистика Яндекс.Музыки: итоги и счетчики артистов/жанров по лайкам и прослушиваниям
+        conn.execute(db.text('''
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id INTEGER PRIMARY KEY,
+                total_liked_tracks INTEGER DEFAULT 0,
+                total_playlists INTEGER DEFAULT 0,
+                largest_playlist INTEGER DEFAULT 0,
+                updated_at INTEGER,
+                recomputed_at INTEGER,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        '''))
+        
+        conn.execute(db.text('''
+            CREATE TABLE IF NOT EXISTS user_stat_counts (
+                user_id INTEGER,
+                kind TEXT NOT NULL,
+                name TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, kind, name),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+        '''))
+        
+        conn.execute(db.text('''
+            CREATE INDEX IF NOT EXISTS idx_user_stat_counts_top
+            ON user_stat_counts (user_id, kind, count)
+        '''))
+        
+        # Счетчики прослушиваний по часам и суткам (заполняет update_listen_rollups)
+        conn.execute(db.text('''
+            CREATE TABLE IF NOT EXISTS listen_rollups (
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                granularity TEXT NOT NULL,
+                bucket_start INTEGER NOT NULL,
+                key TEXT NOT NULL,
+                plays INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, kind, granularity, bucket_start, key)
+            )
+        '''))
         
-        cursor.execute('''
+        conn.execute(db.text('''
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                name TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL DEFAULT 0
+            )
+        '''))
+        
+        # Похожие треки по совместным прослушиваниям (заполняет build_similarity_index.py)
+        conn.execute(db.text('''
+            CREATE TABLE IF NOT EXISTS track_similarity (
+                track_id TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                similar_track_id TEXT NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (track_id, rank)
+            )
+        '''))
+
+        conn.execute(db.text(f'''
             CREATE TABLE IF NOT EXISTS user_themes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {ID_COLUMN},
                 user_id INTEGER,
                 name TEXT NOT NULL,
                 colors TEXT NOT NULL,
                 background_url TEXT,
                 is_default BOOLEAN DEFAULT FALSE,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
-        ''')
+        '''))
         
         
-        db.commit()
+        conn.commit()
+
+# Версионированные изменения схемы: применяются по порядку и отмечаются в schema_migrations.
+# Каждое выражение привязано к таблице и пропускается, если таблицы нет; выражение
+# с колонкой (таблица, колонка, SQL) пропускается, если колонка уже есть
+SCHEMA_MIGRATIONS = [
+    (1, 'secondary indexes for hot queries', [
+        ('user_activity', 'CREATE INDEX IF NOT EXISTS idx_user_activity_user_created ON user_activity (user_id, created_at)'),
+        ('friends', 'CREATE INDEX IF NOT EXISTS idx_friends_friend_user ON friends (friend_id, user_id)'),
+        ('currency_transactions', 'CREATE INDEX IF NOT EXISTS idx_currency_transactions_user_reason_created ON currency_transactions (user_id, reason, created_at)'),
+        ('user_inventory', 'CREATE INDEX IF NOT EXISTS idx_user_inventory_user_item ON user_inventory (user_id, item_id)'),
+        ('user_inventory', 'CREATE INDEX IF NOT EXISTS idx_user_inventory_user_equipped ON user_inventory (user_id, equipped)'),
+    ]),
+    (2, 'users.is_admin for tables created by init_db', [
+        ('users', 'is_admin', 'ALTER TABLE users ADD COLUMN is_admin BOOLEAN DEFAULT FALSE'),
+    ]),
+    (3, 'unique inventory rows per user and item', [
+        ('user_inventory', 'DELETE FROM user_inventory WHERE id NOT IN (SELECT MIN(id) FROM user_inventory GROUP BY user_id, item_id)'),
+        ('user_inventory', 'DROP INDEX IF EXISTS idx_user_inventory_user_item'),
+        ('user_inventory', 'CREATE UNIQUE INDEX IF NOT EXISTS uq_user_inventory_user_item ON user_inventory (user_id, item_id)'),
+    ]),
+    (4, 'currency_transactions.entries for compacted ledger rows', [
+        ('currency_transactions', 'entries', 'ALTER TABLE currency_transactions ADD COLUMN entries INTEGER DEFAULT 1'),
+    ]),
+    (5, 'recount like stats without listens', [
+        ('user_stats', 'UPDATE user_stats SET recomputed_at = NULL'),
+    ]),
+]
+
+def apply_schema_migrations(conn):
+    conn.execute(db.text('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at INTEGER
+        )
+    '''))
+    applied = {row[0] for row in conn.execute(db.text('SELECT version FROM schema_migrations'))}
+    inspector = db.inspect(db.engine)
+    tables = set(inspector.get_table_names())
+    
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        
+        for table, *column, statement in statements:
+            if table not in tables:
+                continue
+            if column and column[0] in {col['name'] for col in inspector.get_columns(table)}:
+                continue
+            conn.execute(db.text(statement))
+        conn.execute(
+            db.text('INSERT INTO schema_migrations (version, description, applied_at) VALUES (:version, :description, :applied_at)'),
+            {'version': version, 'description': description, 'applied_at': int(time.time())}
+        )
+        conn.commit()
+        logger.info(f"Applied schema migration {version}: {description}")
+
+# Явный порядок колонок: таблицу users могли создать и init_db, и db.create_all() с другим порядком
+USER_COLUMNS = (
+    'id, username, display_name, email, password_hash, yandex_token, vk_token, avatar_url, bio, '
+    'email_verified, verification_code, verification_code_expires, created_at, updated_at, is_admin'
+)
+
+# Текущий пользователь без пароля и кодов подтверждения — то, что нужно обработчикам запросов
+CurrentUser = namedtuple('CurrentUser', [
+    'id', 'username', 'display_name', 'email', 'yandex_token', 'vk_token',
+    'avatar_url', 'bio', 'created_at', 'is_admin'
+])
 
 def get_current_user():
-    if 'user_id' in session:
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM users WHERE id = ?', (session['user_id'],))
-        user = cursor.fetchone()
-        return user
-    return None
+    """Текущий пользователь; загружается один раз за запрос и хранится в g"""
+    if not has_request_context() or 'user_id' not in session:
+        return None
+    
+    if '_current_user' not in g:
+        row = get_db().execute(
+            db.text(f'SELECT {", ".join(CurrentUser._fields)} FROM users WHERE id = :id'),
+            {'id': session['user_id']}
+        ).fetchone()
+        g._current_user = CurrentUser(*row) if row else None
+    return g._current_user
+
+def forget_current_user():
+    """Сбросить загруженного пользователя после изменения его строки в users"""
+    g.pop('_current_user', None)
 
 def get_current_user_id():
     user = get_current_user()
-    return user[0] if user else None
+    return user.id if user else None
+
+class ClientPool:
+    """Пул инициализированных клиентов музыкальных сервисов (ключ — хеш токена)"""
+
+    def __init__(self, factory, max_size=256, ttl=600):
+        self._factory = factory
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry and entry[1] > now:
+                self._clients.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self._clients.pop(key, None)
+            self.misses += 1
+
+        # Инициализация идет вне блокировки, чтобы не задерживать другие запросы
+        client = self._factory(token)
+        self.put(token, client)
+        return client
+
+    def put(self, token, client):
+        key = self._key(token)
+        with self._lock:
+            self._clients[key] = (client, time.monotonic() + self._ttl)
+            self._clients.move_to_end(key)
+            while len(self._clients) > self._max_size:
+                self._clients.popitem(last=False)
+
+    def invalidate(self, token):
+        if not token:
+            return
+        with self._lock:
+            self._clients.pop(self._key(token), None)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._clients), 'hits': self.hits, 'misses': self.misses}
+
+yandex_clients = ClientPool(lambda token: Client(token).init())
 
 def get_yandex_client(user_id=None):
     try:
-        db = get_db()
-        cursor = db.cursor()
-        if user_id:
-            cursor.execute('SELECT yandex_token FROM users WHERE id = ?', (user_id,))
-            user = cursor.fetchone()
+        current_user = get_current_user()
+        if user_id and not (current_user and current_user.id == user_id):
+            user = get_db().execute(db.text('SELECT yandex_token FROM users WHERE id = :id'), {'id': user_id}).fetchone()
             token = user[0] if user else None
         else:
-            current_user = get_current_user()
-            token = current_user[5] if current_user else None
+            token = current_user.yandex_token if current_user else None
         
         if not token:
             return None
         
-        client = Client(token).init()
-        return client
+        return yandex_clients.get(token)
     except Exception as e:
         logger.error(f"Error initializing Yandex Music client: {e}")
         return None
 
+# Одна keep-alive сессия на все VK клиенты, чтобы не открывать TLS на каждый запрос
+vk_http = requests.Session()
+vk_http.headers['User-agent'] = DEFAULT_USERAGENT
+vk_http.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
+def normalize_vk_token(token):
+    token = token.strip()
+    if 'access_token=' in token:
+        match = re.search(r'access_token=([^&]+)', token)
+        if match:
+            token = match.group(1)
+    return token
+
+def create_vk_client(token):
+    return vk_api.VkApi(token=token, session=vk_http).get_api()
+
+vk_clients = ClientPool(create_vk_client, max_size=512, ttl=1800)
+
 def get_vk_client(user_id=None):
     try:
-        db = get_db()
-        cursor = db.cursor()
-        if user_id:
-            cursor.execute('SELECT vk_token FROM users WHERE id = ?', (user_id,))
-            user = cursor.fetchone()
+        current_user = get_current_user()
+        if user_id and not (current_user and current_user.id == user_id):
+            user = get_db().execute(db.text('SELECT vk_token FROM users WHERE id = :id'), {'id': user_id}).fetchone()
             token = user[0] if user else None
         else:
-            current_user = get_current_user()
-            token = current_user[6] if current_user else None
+            token = current_user.vk_token if current_user else None
         
         if not token:
             return None
         
-        if 'access_token=' in token:
-            match = re.search(r'access_token=([^&]+)', token)
-            if match:
-                token = match.group(1)
-        
-        session = vk_api.VkApi(token=token)
-        return session.get_api()
+        return vk_clients.get(normalize_vk_token(token))
     except Exception as e:
         logger.error(f"Error initializing VK client: {e}")
         return None
 
+# Пул потоков для параллельных запросов к API музыкальных сервисов
+upstream_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='upstream')
+HYDRATION_CHUNK_SIZE = 50
+
+def format_yandex_track(track):
+    cover_uri = None
+    if hasattr(track, 'cover_uri') and track.cover_uri:
+        cover_uri = f"https://{track.cover_uri.replace('%%', '300x300')}"
+    
+    return {
+        'id': f"yandex_{track.id}",
+        'title': track.title,
+        'artists': [artist.name for artist in track.artists],
+        'album': track.albums[0].title if track.albums else 'Unknown Album',
+        'duration': track.duration_ms,
+        'cover_uri': cover_uri,
+        'year': track.albums[0].year if track.albums and track.albums[0].year else 'Unknown',
+        'service': 'yandex'
+    }
+
+def hydrate_yandex_tracks(client, track_ids):
+    """Загрузить полные данные треков пачками через client.tracks().
+
+    Возвращает (треки в исходном порядке, {track_id: ошибка}) для тех, что не удалось получить.
+    """
+    chunks = [track_ids[i:i + HYDRATION_CHUNK_SIZE] for i in range(0, len(track_ids), HYDRATION_CHUNK_SIZE)]
+    futures = [(upstream_executor.submit(client.tracks, chunk), chunk) for chunk in chunks]
+    
+    by_id = {}
+    failed = {}
+    for future, chunk in futures:
+        try:
+            for track in future.result():
+                by_id[str(track.id)] = track
+        except Exception as e:
+            for track_id in chunk:
+                failed[track_id] = str(e)
+    
+    tracks = []
+    for track_id in track_ids:
+        track = by_id.get(str(track_id).split(':')[0])
+        if track is not None:
+            tracks.append(track)
+        elif track_id not in failed:
+            failed[track_id] = 'Трек не найден'
+    
+    return tracks, failed
+
+def format_yandex_playlist(playlist):
+    cover_uri = None
+    if hasattr(playlist, 'cover') and playlist.cover:
+        if hasattr(playlist.cover, 'uri') and playlist.cover.uri:
+            cover_uri = f"https://{playlist.cover.uri.replace('%%', '400x400')}"
+
+    modified_date = None
+    if hasattr(playlist, 'modified') and playlist.modified:
+        if hasattr(playlist.modified, 'isoformat'):
+            modified_date = playlist.modified.isoformat()
+        else:
+            modified_date = str(playlist.modified)
+
+    return {
+        'id': f"yandex_{playlist.kind}",
+        'title': playlist.title,
+        'track_count': playlist.track_count,
+        'cover_uri': cover_uri,
+        'modified': modified_date,
+        'description': getattr(playlist, 'description', '') or '',
+        'owner': getattr(playlist.owner, 'login', '') if hasattr(playlist, 'owner') else '',
+        'service': 'yandex'
+    }
+
+# Как часто сверять ревизии медиатеки с Яндексом (секунды)
+LIBRARY_SYNC_INTERVAL = 60
+
+def _get_library_sync_state(conn, user_id, resource):
+    return conn.execute(
+        db.text("SELECT revision, synced_at FROM library_sync WHERE user_id = :user_id AND service = 'yandex' AND resource = :resource"),
+        {'user_id': user_id, 'resource': resource}
+    ).fetchone()
+
+def _save_library_sync_state(conn, user_id, resource, revision):
+    conn.execute(db.text('''
+        INSERT INTO library_sync (user_id, service, resource, revision, synced_at)
+        VALUES (:user_id, 'yandex', :resource, :revision, :synced_at)
+        ON CONFLICT (user_id, service, resource) DO UPDATE SET
+            revision = excluded.revision,
+            synced_at = excluded.synced_at
+    '''), {'user_id': user_id, 'resource': resource, 'revision': revision, 'synced_at': int(time.time())})
+
+def sync_yandex_likes(user_id, client, force=False):
+    """Синхронизировать лайкнутые треки с локальным зеркалом.
+
+    Запрашивает у Яндекса список только если ревизия изменилась и сохраняет
+    id и позиции; данные новых треков догружаются постранично и в фоне.
+    Возвращает текущую ревизию.
+    """
+    conn = get_db()
+    state = _get_library_sync_state(conn, user_id, 'likes')
+    if state and not force and time.time() - (state[1] or 0) < LIBRARY_SYNC_INTERVAL:
+        return state[0]
+
+    known_revision = state[0] if state else 0
+    liked_tracks = client.users_likes_tracks(if_modified_since_revision=known_revision or 0)
+
+    if liked_tracks is None or (state and liked_tracks.revision == known_revision):
+        _save_library_sync_state(conn, user_id, 'likes', known_revision)
+        conn.commit()
+        return known_revision
+
+    liked_ids = [track_short.track_id for track_short in liked_tracks]
+    local_ids = [f"yandex_{str(track_id).split(':')[0]}" for track_id in liked_ids]
+
+    stored = dict(conn.execute(
+        db.text('SELECT track_id, track_data IS NOT NULL FROM library_tracks WHERE user_id = :user_id'),
+        {'user_id': user_id}
+    ).fetchall())
+
+    # Данные удаленных из лайков треков нужны, чтобы вычесть их из статистики
+    removed_ids = list(set(stored) - set(local_ids))
+    removed_tracks = []
+    if removed_ids:
+        removed_tracks = [json.loads(row[0]) for row in conn.execute(db.text('''
+            SELECT track_data FROM library_tracks
+            WHERE user_id = :user_id AND track_id IN :track_ids AND track_data IS NOT NULL
+        ''').bindparams(db.bindparam('track_ids', expanding=True)), {'user_id': user_id, 'track_ids': removed_ids})]
+        conn.execute(
+            db.text('DELETE FROM library_tracks WHERE user_id = :user_id AND track_id = :track_id'),
+            [{'user_id': user_id, 'track_id': track_id} for track_id in removed_ids]
+        )
+
+    # Новые треки сохраняются без данных: их загружают hydrate_library_tracks и фоновая догрузка
+    if local_ids:
+        conn.execute(db.text('''
+            INSERT INTO library_tracks (user_id, track_id, position) VALUES (:user_id, :track_id, :position)
+            ON CONFLICT (user_id, track_id) DO UPDATE SET position = excluded.position
+        '''), [{'user_id': user_id, 'track_id': local_id, 'position': position} for position, local_id in enumerate(local_ids)])
+    
+    bump_user_stats(conn, user_id, removed_tracks, delta=-1)
+    _save_user_stats(conn, user_id, total_liked_tracks=len(local_ids))
+
+    _save_library_sync_state(conn, user_id, 'likes', liked_tracks.revision)
+    conn.commit()
+    
+    if any(not stored.get(local_id) for local_id in local_ids):
+        schedule_library_backfill(user_id, client)
+    return liked_tracks.revision
+
+def hydrate_library_tracks(user_id, client, local_ids):
+    """Загрузить данные треков зеркала, у которых их еще нет.
+    
+    Возвращает {track_id: ошибка} для треков, которые загрузить не удалось.
+    """
+    if not local_ids:
+        return {}
+    
+    hydrated, failed = hydrate_yandex_tracks(client, [local_id.split('_', 1)[1] for local_id in local_ids])
+    failed = {f"yandex_{track_id}": error for track_id, error in failed.items()}
+    
+    new_tracks = []
+    for track in hydrated:
+        try:
+            track_dict = format_yandex_track(track)
+            track_dict['genre'] = track.albums[0].genre if track.albums and track.albums[0].genre else None
+            new_tracks.append(track_dict)
+        except Exception as e:
+            failed[f"yandex_{track.id}"] = str(e)
+    
+    conn = get_db()
+    # Трек мог загрузить параллельный запрос или фоновая догрузка — статистику считаем один раз
+    saved = []
+    for track in new_tracks:
+        result = conn.execute(
+            db.text('UPDATE library_tracks SET track_data = :track_data WHERE user_id = :user_id AND track_id = :track_id AND track_data IS NULL'),
+            {'track_data': json.dumps(track), 'user_id': user_id, 'track_id': track['id']}
+        )
+        if result.rowcount:
+            saved.append(track)
+    bump_user_stats(conn, user_id, saved)
+    conn.commit()
+    
+    return failed
+
+LIBRARY_BACKFILL_BATCH = 200
+
+# Догрузка библиотеки идет в своем пуле: у большой библиотеки она занимает минуты и не должна
+# держать background_executor, где считаются роллапы, статистика и рекомендации.
+# Задача грузит одну пачку и ставит следующую в конец очереди, поэтому библиотеки
+# нескольких пользователей догружаются поочередно
+library_backfill_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='library-backfill')
+
+_library_backfilling = set()
+_library_backfill_lock = threading.Lock()
+
+def schedule_library_backfill(user_id, client):
+    """Догрузить в фоне данные всех треков зеркала без данных; одна очередь пачек на пользователя"""
+    with _library_backfill_lock:
+        if user_id in _library_backfilling:
+            return
+        _library_backfilling.add(user_id)
+    
+    # Не загрузившиеся треки пропускаются до следующей синхронизации
+    skipped = set()
+    
+    def backfill_batch():
+        more = False
+        try:
+            with app.app_context():
+                rows = get_db().execute(db.text('''
+                    SELECT track_id FROM library_tracks
+                    WHERE user_id = :user_id AND track_data IS NULL
+                    ORDER BY position
+                    LIMIT :limit
+                '''), {'user_id': user_id, 'limit': LIBRARY_BACKFILL_BATCH + len(skipped)}).fetchall()
+                batch = [row[0] for row in rows if row[0] not in skipped][:LIBRARY_BACKFILL_BATCH]
+                if batch:
+                    failed = hydrate_library_tracks(user_id, client, batch)
+                    skipped.update(failed)
+                    if len(failed) == len(batch):
+                        logger.warning(f"Library backfill for user {user_id}: {len(failed)} tracks failed, stopping")
+                    else:
+                        more = True
+        except Exception as e:
+            logger.error(f"Library backfill error: {e}")
+    
+        if more:
+            try:
+                library_backfill_executor.submit(backfill_batch)
+                return
+            except RuntimeError:
+                # Пул уже остановлен — процесс завершается
+                pass
+        with _library_backfill_lock:
+            _library_backfilling.discard(user_id)
+    
+    library_backfill_executor.submit(backfill_batch)
+
+def sync_yandex_playlists(user_id, client, force=False):
+    """Синхронизировать список плейлистов; перезаписываются только плейлисты с новой ревизией"""
+    conn = get_db()
+    state = _get_library_sync_state(conn, user_id, 'playlists')
+    if state and not force and time.time() - (state[1] or 0) < LIBRARY_SYNC_INTERVAL:
+        return
+
+    playlists = client.users_playlists_list()
+
+    known_revisions = dict(conn.execute(
+        db.text('SELECT playlist_id, revision FROM library_playlists WHERE user_id = :user_id'),
+        {'user_id': user_id}
+    ).fetchall())
+
+    seen_ids = set()
+    for position, playlist in enumerate(playlists):
+        playlist_id = f"yandex_{playlist.kind}"
+        seen_ids.add(playlist_id)
+
+        if playlist_id in known_revisions and known_revisions[playlist_id] == playlist.revision:
+            conn.execute(
+                db.text('UPDATE library_playlists SET position = :position WHERE user_id = :user_id AND playlist_id = :playlist_id'),
+                {'position': position, 'user_id': user_id, 'playlist_id': playlist_id}
+            )
+            continue
+
+        conn.execute(db.text('''
+            INSERT INTO library_playlists
+            (user_id, playlist_id, position, revision, collective, playlist_data)
+            VALUES (:user_id, :playlist_id, :position, :revision, :collective, :playlist_data)
+            ON CONFLICT (user_id, playlist_id) DO UPDATE SET
+                position = excluded.position,
+                revision = excluded.revision,
+                collective = excluded.collective,
+                playlist_data = excluded.playlist_data
+        '''), {
+            'user_id': user_id,
+            'playlist_id': playlist_id,
+            'position': position,
+            'revision': playlist.revision,
+            'collective': bool(getattr(playlist, 'collective', False)),
+            'playlist_data': json.dumps(format_yandex_playlist(playlist))
+        })
+
+    removed_ids = set(known_revisions) - seen_ids
+    if removed_ids:
+        conn.execute(
+            db.text('DELETE FROM library_playlists WHERE user_id = :user_id AND playlist_id = :playlist_id'),
+            [{'user_id': user_id, 'playlist_id': playlist_id} for playlist_id in removed_ids]
+        )
+
+    _save_user_stats(
+        conn, user_id,
+        total_playlists=len(playlists),
+        largest_playlist=max([playlist.track_count or 0 for playlist in playlists], default=0),
+        updated_at=int(time.time())
+    )
+    
+    _save_library_sync_state(conn, user_id, 'playlists', None)
+    conn.commit()
+
+def get_library_tracks(user_id, offset=0, limit=None):
+    """Пары (track_id, данные трека) из зеркала; для не загруженных треков данные — None"""
+    query = 'SELECT track_id, track_data FROM library_tracks WHERE user_id = :user_id ORDER BY position'
+    if limit is not None:
+        query += ' LIMIT :limit OFFSET :offset'
+    rows = get_db().execute(db.text(query), {'user_id': user_id, 'limit': limit, 'offset': offset})
+    return [(row[0], json.loads(row[1]) if row[1] else None) for row in rows]
+
+def count_library_tracks(user_id):
+    return get_db().execute(
+        db.text('SELECT COUNT(*) FROM library_tracks WHERE user_id = :user_id'),
+        {'user_id': user_id}
+    ).scalar()
+
+def get_library_playlists(user_id, include_collective=True):
+    query = 'SELECT playlist_data FROM library_playlists WHERE user_id = :user_id'
+    if not include_collective:
+        query += ' AND NOT collective'
+    rows = get_db().execute(db.text(query + ' ORDER BY position'), {'user_id': user_id})
+    return [json.loads(row[0]) for row in rows]
+
+TRACK_COLUMNS = 'title, artists, album, genre, duration, cover_uri'
+TRACK_LOOKUP_CHUNK_SIZE = 500
+
+def track_from_row(row):
+    """Данные трека из колонок TRACK_COLUMNS в том же виде, что раньше хранился track_data"""
+    title, artists, album, genre, duration, cover_uri = row
+    return {
+        'title': title,
+        'artists': json.loads(artists) if artists else [],
+        'album': album,
+        'genre': genre,
+        'duration': duration,
+        'cover_uri': cover_uri
+    }
+
+def save_tracks(conn, tracks):
+    """Добавить или обновить треки справочника по {track_key: данные}; возвращает {track_key: id}"""
+    if not tracks:
+        return {}
+    
+    conn.execute(db.text(f'''
+        INSERT INTO tracks (track_key, {TRACK_COLUMNS})
+        VALUES (:track_key, :title, :artists, :album, :genre, :duration, :cover_uri)
+        ON CONFLICT (track_key) DO UPDATE SET
+            title = excluded.title,
+            artists = excluded.artists,
+            album = excluded.album,
+            genre = excluded.genre,
+            duration = excluded.duration,
+            cover_uri = excluded.cover_uri
+    '''), [{
+        'track_key': track_key,
+        'title': data.get('title'),
+        'artists': json.dumps(data.get('artists') or []),
+        'album': data.get('album'),
+        'genre': data.get('genre'),
+        'duration': data.get('duration'),
+        'cover_uri': data.get('cover_uri')
+    } for track_key, data in tracks.items()])
+    
+    query = db.text('SELECT track_key, id FROM tracks WHERE track_key IN :track_keys').bindparams(
+        db.bindparam('track_keys', expanding=True)
+    )
+    track_keys = list(tracks)
+    track_ids = {}
+    for i in range(0, len(track_keys), TRACK_LOOKUP_CHUNK_SIZE):
+        track_ids.update(conn.execute(query, {'track_keys': track_keys[i:i + TRACK_LOOKUP_CHUNK_SIZE]}).fetchall())
+    return track_ids
+
+def get_tracks(conn, track_keys):
+    """Данные треков справочника по ключам service_trackid; {track_key: данные}"""
+    query = db.text(f'SELECT track_key, {TRACK_COLUMNS} FROM tracks WHERE track_key IN :track_keys').bindparams(
+        db.bindparam('track_keys', expanding=True)
+    )
+    tracks = {}
+    for i in range(0, len(track_keys), TRACK_LOOKUP_CHUNK_SIZE):
+        rows = conn.execute(query, {'track_keys': track_keys[i:i + TRACK_LOOKUP_CHUNK_SIZE]})
+        tracks.update((row[0], track_from_row(row[1:])) for row in rows)
+    return tracks
+
+# Полный пересчет статистики раз в сутки исправляет расхождения инкрементальных обновлений
+STATS_RECOMPUTE_INTERVAL = 24 * 3600
+STATS_TOP_ARTISTS = 5
+STATS_TOP_GENRES = 10
+
+def _save_user_stats(conn, user_id, **fields):
+    conn.execute(
+        db.text('INSERT INTO user_stats (user_id) VALUES (:user_id) ON CONFLICT (user_id) DO NOTHING'),
+        {'user_id': user_id}
+    )
+    assignments = ', '.join(f'{name} = :{name}' for name in fields)
+    conn.execute(db.text(f'UPDATE user_stats SET {assignments} WHERE user_id = :user_id'), {**fields, 'user_id': user_id})
+
+def bump_user_stats(conn, user_id, tracks, delta=1):
+    """Прибавить (или вычесть при delta=-1) треки к счетчикам артистов и жанров"""
+    rows = []
+    for track in tracks:
+        for artist_name in track.get('artists') or []:
+            rows.append({'user_id': user_id, 'kind': 'artist', 'name': artist_name, 'count': delta})
+        genre = track.get('genre')
+        if genre and genre != 'Unknown':
+            rows.append({'user_id': user_id, 'kind': 'genre', 'name': genre, 'count': delta})
+    
+    if rows:
+        conn.execute(db.text('''
+            INSERT INTO user_stat_counts (user_id, kind, name, count) VALUES (:user_id, :kind, :name, :count)
+            ON CONFLICT (user_id, kind, name) DO UPDATE SET count = user_stat_counts.count + excluded.count
+        '''), rows)
+    if delta < 0:
+        conn.execute(db.text('DELETE FROM user_stat_counts WHERE user_id = :user_id AND count <= 0'), {'user_id': user_id})
+    _save_user_stats(conn, user_id, updated_at=int(time.time()))
+
+def recompute_user_stats(user_id):
+    """Пересчитать статистику целиком по зеркалу медиатеки (только лайки)"""
+    conn = get_db()
+    
+    tracks = [track for _, track in get_library_tracks(user_id) if track]
+    playlists = get_library_playlists(user_id)
+    
+    conn.execute(db.text('DELETE FROM user_stat_counts WHERE user_id = :user_id'), {'user_id': user_id})
+    bump_user_stats(conn, user_id, tracks)
+    _save_user_stats(
+        conn, user_id,
+        total_liked_tracks=count_library_tracks(user_id),
+        total_playlists=len(playlists),
+        largest_playlist=max([p['track_count'] or 0 for p in playlists], default=0),
+        recomputed_at=int(time.time())
+    )
+    conn.commit()
+
+_stats_recomputing = set()
+_stats_lock = threading.Lock()
+
+def schedule_stats_recompute(user_id):
+    with _stats_lock:
+        if user_id in _stats_recomputing:
+            return
+        _stats_recomputing.add(user_id)
+    
+    def recompute():
+        try:
+            with app.app_context():
+                recompute_user_stats(user_id)
+        except Exception as e:
+            logger.error(f"Stats recompute error: {e}")
+        finally:
+            with _stats_lock:
+                _stats_recomputing.discard(user_id)
+    
+    background_executor.submit(recompute)
+
+# Счетчики прослушиваний по временным корзинам (UTC). Часовые хранятся две недели,
+# суточные — всегда; для старых дат края диапазона округляются до суток
+ROLLUP_GRANULARITIES = {'hour': 3600, 'day': 86400}
+ROLLUP_HOURLY_RETENTION = 14 * 86400
+ROLLUP_BATCH_SIZE = 5000
+ROLLUP_KINDS = ('track', 'artist', 'genre')
+
+def update_listen_rollups(batch_size=ROLLUP_BATCH_SIZE):
+    """Добавить в счетчики прослушивания после high-water mark.
+    
+    Обрабатывает не больше batch_size строк play_events и возвращает их число.
+    """
+    conn = get_db()
+    conn.execute(db.text("INSERT INTO rollup_state (name, last_id) VALUES ('listens', 0) ON CONFLICT (name) DO NOTHING"))
+    last_id = conn.execute(db.text("SELECT last_id FROM rollup_state WHERE name = 'listens'")).scalar()
+    
+    rows = conn.execute(db.text('''
+        SELECT play_events.id, play_events.user_id, tracks.track_key, tracks.artists, tracks.genre, play_events.played_at
+        FROM play_events
+        JOIN tracks ON tracks.id = play_events.track_id
+        WHERE play_events.id > :last_id
+        ORDER BY play_events.id
+        LIMIT :limit
+    '''), {'last_id': last_id, 'limit': batch_size}).fetchall()
+    if not rows:
+        conn.commit()
+        return 0
+    
+    counts = Counter()
+    for _, user_id, track_key, artists, genre, played in rows:
+        keys = [('track', track_key)] + [('artist', artist_name) for artist_name in json.loads(artists or '[]')]
+        if genre and genre != 'Unknown':
+            keys.append(('genre', genre))
+        
+        for granularity, size in ROLLUP_GRANULARITIES.items():
+            for kind, key in keys:
+                counts[(user_id, kind, granularity, played - played % size, key)] += 1
+    
+    conn.execute(db.text('''
+        INSERT INTO listen_rollups (user_id, kind, granularity, bucket_start, key, plays)
+        VALUES (:user_id, :kind, :granularity, :bucket_start, :key, :plays)
+        ON CONFLICT (user_id, kind, granularity, bucket_start, key) DO UPDATE SET plays = listen_rollups.plays + excluded.plays
+    '''), [
+        dict(zip(('user_id', 'kind', 'granularity', 'bucket_start', 'key'), bucket), plays=plays)
+        for bucket, plays in counts.items()
+    ])
+    
+    # Метка сдвигается только с того значения, с которого читали, иначе пачку уже посчитал другой процесс
+    result = conn.execute(
+        db.text("UPDATE rollup_state SET last_id = :new_id WHERE name = 'listens' AND last_id = :last_id"),
+        {'new_id': rows[-1][0], 'last_id': last_id}
+    )
+    if result.rowcount != 1:
+        conn.rollback()
+        return 0
+    
+    conn.execute(
+        db.text("DELETE FROM listen_rollups WHERE granularity = 'hour' AND bucket_start < :before"),
+        {'before': int(time.time()) - ROLLUP_HOURLY_RETENTION}
+    )
+    conn.commit()
+    return len(rows)
+
+_rollup_updating = threading.Lock()
+
+def schedule_rollup_update():
+    """Догнать high-water mark в фоне; одновременно выполняется не больше одного обновления"""
+    if not _rollup_updating.acquire(blocking=False):
+        return
+    
+    def update():
+        try:
+            with app.app_context():
+                while update_listen_rollups() == ROLLUP_BATCH_SIZE:
+                    pass
+        except Exception as e:
+            logger.error(f"Listen rollups update error: {e}")
+        finally:
+            _rollup_updating.release()
+    
+    background_executor.submit(update)
+
+def _rollup_ranges(start, end):
+    """Разбить [start, end) на целые сутки и часовые края"""
+    day = ROLLUP_GRANULARITIES['day']
+    hour = ROLLUP_GRANULARITIES['hour']
+    hour_limit = int(time.time()) - ROLLUP_HOURLY_RETENTION
+    
+    first_day = start if start % day == 0 else start - start % day + day
+    last_day = max(end - end % day, first_day)
+    
+    ranges = []
+    if first_day < last_day:
+        ranges.append(('day', first_day, last_day))
+    for edge_start, edge_end in ((start, min(first_day, end)), (last_day, end)):
+        if edge_start >= edge_end:
+            continue
+        if edge_start < hour_limit:
+            ranges.append(('day', edge_start - edge_start % day, edge_end))
+        else:
+            ranges.append(('hour', edge_start - edge_start % hour, edge_end))
+    return ranges
+
+def get_top_listened(user_id, kind, start, end, limit=10):
+    """Top-N треков, артистов или жанров за [start, end) по счетчикам; пары (ключ, прослушивания)"""
+    ranges = _rollup_ranges(start, end)
+    if not ranges:
+        return []
+    
+    conditions = ' OR '.join(
+        f'(granularity = :granularity_{i} AND bucket_start >= :start_{i} AND bucket_start < :end_{i})'
+        for i in range(len(ranges))
+    )
+    params = {'user_id': user_id, 'kind': kind, 'limit': limit}
+    for i, (granularity, range_start, range_end) in enumerate(ranges):
+        params.update({f'granularity_{i}': granularity, f'start_{i}': range_start, f'end_{i}': range_end})
+    rows = get_db().execute(db.text(f'''
+        SELECT key, SUM(plays) AS total FROM listen_rollups
+        WHERE user_id = :user_id AND kind = :kind AND ({conditions})
+        GROUP BY key
+        ORDER BY total DESC
+        LIMIT :limit
+    '''), params)
+    return [tuple(row) for row in rows]
+
+def get_listen_timeline(user_id, start, end, granularity='day'):
+    """Число прослушиваний по корзинам за [start, end); пары (начало корзины, прослушивания)"""
+    size = ROLLUP_GRANULARITIES[granularity]
+    rows = get_db().execute(db.text('''
+        SELECT bucket_start, SUM(plays) FROM listen_rollups
+        WHERE user_id = :user_id AND kind = 'track' AND granularity = :granularity
+            AND bucket_start >= :start AND bucket_start < :end
+        GROUP BY bucket_start
+        ORDER BY bucket_start
+    '''), {'user_id': user_id, 'granularity': granularity, 'start': start - start % size, 'end': end})
+    return [tuple(row) for row in rows]
+
+# Настройки читаются почти в каждом запросе к API, поэтому держатся в кеше.
+# POST /api/settings записывает их сразу и в базу, и в кеш, но только в кеш своего
+# процесса: у остальных воркеров старые настройки (например, music_service) живут
+# до истечения TTL, поэтому он короткий — кеш лишь снимает повторные чтения
+# в пачке запросов при открытии страницы
+SETTINGS_CACHE_TTL = 5
+
+def get_user_settings(user_id):
+    """Настройки пользователя словарем; пустой словарь, если пользователь их не сохранял"""
+    settings = cache.get(f'settings_{user_id}')
+    if settings is not None:
+        return settings
+    
+    row = get_db().execute(
+        db.text('SELECT theme, language, auto_play, show_explicit, music_service FROM user_settings WHERE user_id = :user_id'),
+        {'user_id': user_id}
+    ).fetchone()
+    settings = {
+        'theme': row[0],
+        'language': row[1],
+        'auto_play': bool(row[2]),
+        'show_explicit': bool(row[3]),
+        'music_service': row[4]
+    } if row else {}
+    cache.set(f'settings_{user_id}', settings, timeout=SETTINGS_CACHE_TTL)
+    return settings
+
 def get_current_music_service(user_id=None):
-    db = get_db()
-    cursor = db.cursor()
     if not user_id:
         user_id = get_current_user_id()
     
-    cursor.execute('SELECT music_service FROM user_settings WHERE user_id = ?', (user_id,))
-    setting = cursor.fetchone()
-    return setting[0] if setting else 'yandex'
+    return get_user_settings(user_id).get('music_service') or 'yandex'
 
 def send_verification_email(email, verification_code):
     try:
@@ -476,23 +1560,105 @@ def save_uploaded_file(file_data, filename):
         logger.error(f"Error saving uploaded file: {e}")
         return None
 
+# Общий дедлайн на параллельные запросы рекомендаций (секунды)
+RECOMMENDATIONS_DEADLINE = 4
+# Пул кандидатов хранится в кеше и отдается выборкой из RECOMMENDATIONS_COUNT треков
+RECOMMENDATIONS_COUNT = 8
+RECOMMENDATIONS_PER_QUERY = 5
+RECOMMENDATIONS_POOL_TTL = 6 * 3600
+RECOMMENDATIONS_EMPTY_POOL_TTL = 60
+RECOMMENDATIONS_REFRESH_AFTER = 1800
+RECOMMENDATIONS_MIN_REFRESH_INTERVAL = 120
+
+# Фоновые задачи (обновление пулов рекомендаций и т.п.) — отдельно от upstream_executor,
+# потому что сами отправляют в него запросы
+background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='background')
+
 class EnhancedRecommender:
     def __init__(self):
-        pass
+        self._refreshing = set()
+        self._lock = threading.Lock()
+    
+    def get_recommendations(self, user_id, service='yandex', count=RECOMMENDATIONS_COUNT):
+        """Выборка из заранее посчитанного пула; пул обновляется в фоне"""
+        pool = cache.get(f'recommendations_{user_id}')
+        
+        if not pool or pool['service'] != service:
+            pool = self.refresh_pool(user_id, service)
+        else:
+            age = time.time() - pool['built_at']
+            if age > RECOMMENDATIONS_REFRESH_AFTER or (pool['stale'] and age > RECOMMENDATIONS_MIN_REFRESH_INTERVAL):
+                self.schedule_refresh(user_id, service)
+        
+        items = pool['items']
+        return random.sample(items, min(count, len(items)))
+    
+    def refresh_pool(self, user_id, service):
+        pool = {
+            'service': service,
+            'items': self.get_enhanced_recommendations(user_id, service),
+            'built_at': time.time(),
+            'stale': False
+        }
+        
+        # Пустой пул обычно означает сбой или таймаут источников: прежний пул не затираем,
+        # а пустой храним недолго, чтобы следующий запрос собрал его заново
+        if not pool['items']:
+            previous = cache.get(f'recommendations_{user_id}')
+            if previous and previous['items'] and previous['service'] == service:
+                return previous
+            cache.set(f'recommendations_{user_id}', pool, timeout=RECOMMENDATIONS_EMPTY_POOL_TTL)
+            return pool
+        
+        cache.set(f'recommendations_{user_id}', pool, timeout=RECOMMENDATIONS_POOL_TTL)
+        return pool
+    
+    def schedule_refresh(self, user_id, service):
+        with self._lock:
+            if user_id in self._refreshing:
+                return
+            self._refreshing.add(user_id)
+        
+        def refresh():
+            try:
+                with app.app_context():
+                    self.refresh_pool(user_id, service)
+            except Exception as e:
+                logger.error(f"Recommendations pool refresh error: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(user_id)
+        
+        background_executor.submit(refresh)
+    
+    def note_listen(self, user_id):
+        """Пометить пул устаревшим после нового прослушивания"""
+        pool = cache.get(f'recommendations_{user_id}')
+        if not pool or pool['stale']:
+            return
+        
+        pool['stale'] = True
+        cache.set(f'recommendations_{user_id}', pool, timeout=RECOMMENDATIONS_POOL_TTL)
+        if time.time() - pool['built_at'] > RECOMMENDATIONS_MIN_REFRESH_INTERVAL:
+            self.schedule_refresh(user_id, pool['service'])
     
     def get_enhanced_recommendations(self, user_id, service='yandex'):
-        """Получение рекомендаций из нескольких источников"""
+        """Получение пула рекомендаций из нескольких источников"""
         recommendations = []
         
         try:
+            # Похожие по совместным прослушиваниям — из локального индекса, без запросов к API
+            recommendations.extend(self._get_co_listened_recommendations(user_id, service))
+            
             if service == 'yandex':
                 client = get_yandex_client(user_id)
                 if client:
-                    history_recs = self._get_history_based_recommendations(user_id, client)
-                    recommendations.extend(history_recs)
+                    deadline = time.monotonic() + RECOMMENDATIONS_DEADLINE
                     
-                    liked_recs = self._get_liked_based_recommendations(user_id, client)
-                    recommendations.extend(liked_recs)
+                    # Все запросы к Яндексу уходят в пул сразу, ответы собираются до дедлайна
+                    futures = self._get_history_based_recommendations(user_id, client)
+                    futures += self._get_liked_based_recommendations(user_id, client)
+                    recommendations.extend(self._collect(futures, deadline))
                     
                     if not recommendations:
                         fallback_recs = self._get_fallback_recommendations(client)
@@ -504,95 +1670,143 @@ class EnhancedRecommender:
                     vk_recs = self._get_vk_recommendations(vk_client)
                     recommendations.extend(vk_recs)
             
-            return self._deduplicate_and_shuffle(recommendations)
+            return self._deduplicate(recommendations)
             
         except Exception as e:
             logger.error(f"Enhanced recommendations error: {e}")
             return []
     
-    def _get_history_based_recommendations(self, user_id, client):
+    def _collect(self, futures, deadline):
+        """Собрать результаты запросов, успевших завершиться до дедлайна"""
+        done, pending = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        
+        for future in pending:
+            future.cancel()
+        if pending:
+            logger.warning(f"Recommendations: {len(pending)} upstream calls missed the deadline")
+        
+        recommendations = []
+        for future in done:
+            try:
+                recommendations.extend(future.result())
+            except Exception as e:
+                logger.warning(f"Recommendations upstream call failed: {e}")
+        return recommendations
+    
+    def _get_co_listened_recommendations(self, user_id, service, limit=20):
         try:
-            # Получаем историю прослушивания из базы
-            db = get_db()
-            cursor = db.cursor()
-            cursor.execute('''
-                SELECT track_data FROM listening_history 
-                WHERE user_id = ? 
-                ORDER BY played_at DESC 
+            conn = get_db()
+            recent_ids = [row[0] for row in conn.execute(db.text('''
+                SELECT tracks.track_key FROM play_events
+                JOIN tracks ON tracks.id = play_events.track_id
+                WHERE play_events.user_id = :user_id AND tracks.track_key LIKE :prefix
+                GROUP BY tracks.track_key
+                ORDER BY MAX(play_events.played_at) DESC
                 LIMIT 20
-            ''', (user_id,))
+            '''), {'user_id': user_id, 'prefix': f"{service}_%"})]
+            if not recent_ids:
+                return []
             
-            history_tracks = []
-            for row in cursor.fetchall():
-                try:
-                    track_data = json.loads(row[0])
-                    history_tracks.append(track_data)
-                except:
+            similar_ids = [row[0] for row in conn.execute(db.text('''
+                SELECT similar_track_id, SUM(score) AS total_score FROM track_similarity
+                WHERE track_id IN :track_ids AND similar_track_id NOT IN :track_ids
+                GROUP BY similar_track_id
+                ORDER BY total_score DESC
+                LIMIT :limit
+            ''').bindparams(db.bindparam('track_ids', expanding=True)), {'track_ids': recent_ids, 'limit': limit})]
+            if not similar_ids:
+                return []
+            
+            track_data = get_tracks(conn, similar_ids)
+            
+            recommendations = []
+            for track_id in similar_ids:
+                data = track_data.get(track_id)
+                if not data:
                     continue
+                recommendations.append({
+                    'id': track_id,
+                    'title': data.get('title'),
+                    'type': 'track',
+                    'artists': data.get('artists', []),
+                    'cover_uri': data.get('cover_uri'),
+                    'album': data.get('album', 'Unknown Album'),
+                    'duration': data.get('duration', 0),
+                    'source': 'co_listened'
+                })
+            return recommendations
+        
+        except Exception as e:
+            logger.error(f"Co-listened recommendations error: {e}")
+            return []
+    
+    def _search_tracks(self, client, query, source, limit=RECOMMENDATIONS_PER_QUERY, exclude_id=None):
+        search_results = client.search(query, type_='track')
+        if not search_results or not search_results.tracks:
+            return []
+        
+        return [
+            self._format_track(track, source)
+            for track in search_results.tracks.results[:limit]
+            if str(track.id) != str(exclude_id)
+        ]
+    
+    def _get_history_based_recommendations(self, user_id, client):
+        """Запустить поиск по жанрам и артистам из истории; возвращает список futures"""
+        try:
+            # Получаем историю прослушивания из базы
+            history_tracks = [track_from_row(row) for row in get_db().execute(db.text(f'''
+                SELECT {TRACK_COLUMNS} FROM play_events
+                JOIN tracks ON tracks.id = play_events.track_id
+                WHERE play_events.user_id = :user_id
+                ORDER BY play_events.played_at DESC
+                LIMIT 20
+            '''), {'user_id': user_id})]
             
             if not history_tracks:
                 return []
             
-            recommendations = []
+            futures = []
             
             genres = self._extract_genres_from_history(history_tracks)
-            if genres:
-                for genre in genres[:2]: 
-                    try:
-                        search_results = client.search(f"жанр:{genre}", type_='track')
-                        if search_results and search_results.tracks:
-                            for track in search_results.tracks.results[:2]:
-                                recommendations.append(self._format_track(track, 'history_genre'))
-                    except:
-                        continue
+            for genre in genres[:2]:
+                futures.append(upstream_executor.submit(
+                    self._search_tracks, client, f"жанр:{genre}", 'history_genre'
+                ))
             
             artists = self._extract_artists_from_history(history_tracks)
-            if artists:
-                for artist in artists[:2]:
-                    try:
-                        search_results = client.search(artist, type_='track')
-                        if search_results and search_results.tracks:
-                            for track in search_results.tracks.results[:2]:
-                                if not any(t['id'] == f"yandex_{track.id}" for t in recommendations):
-                                    recommendations.append(self._format_track(track, 'history_artist'))
-                    except:
-                        continue
+            for artist in artists[:2]:
+                futures.append(upstream_executor.submit(
+                    self._search_tracks, client, artist, 'history_artist'
+                ))
             
-            return recommendations
+            return futures
             
         except Exception as e:
             logger.error(f"History based recommendations error: {e}")
             return []
     
+    def _get_liked_seed_tracks(self, user_id):
+        # Лайки берем из зеркала медиатеки без синхронизации: ее делают дашборд и /api/liked_tracks,
+        # а здесь запрос к Яндексу вышел бы за RECOMMENDATIONS_DEADLINE
+        liked_tracks = [track for _, track in get_library_tracks(user_id, limit=10) if track]
+        
+        # Берем 3 случайных лайкнутых трека
+        return random.sample(liked_tracks, min(3, len(liked_tracks)))
+    
     def _get_liked_based_recommendations(self, user_id, client):
+        """Найти похожие на лайкнутые треки; возвращает список futures"""
         try:
-            liked_tracks = client.users_likes_tracks()
-            if not liked_tracks:
-                return []
-            
-            recommendations = []
+            futures = []
+            for track in self._get_liked_seed_tracks(user_id):
+                # Ищем похожие треки
+                search_query = f"{track['title']} {track['artists'][0] if track['artists'] else ''}"
+                futures.append(upstream_executor.submit(
+                    self._search_tracks, client, search_query, 'liked_similar',
+                    exclude_id=track['id'].split('_', 1)[1]
+                ))
             
-            # Берем 3 случайных лайкнутых трека
-            sample_tracks = random.sample(list(liked_tracks[:10]), min(3, len(liked_tracks)))
-            
-            for track_short in sample_tracks:
-                try:
-                    track = track_short.fetch_track()
-                    
-                    # Ищем похожие треки
-                    search_query = f"{track.title} {track.artists[0].name if track.artists else ''}"
-                    similar_tracks = client.search(search_query, type_='track')
-                    
-                    if similar_tracks and similar_tracks.tracks:
-                        for similar in similar_tracks.tracks.results[:2]:
-                            if similar.id != track.id:
-                                recommendations.append(self._format_track(similar, 'liked_similar'))
-                
-                except Exception as e:
-                    logger.warning(f"Error processing liked track: {e}")
-                    continue
-            
-            return recommendations
+            return futures
             
         except Exception as e:
             logger.error(f"Liked based recommendations error: {e}")
@@ -602,7 +1816,10 @@ class EnhancedRecommender:
         recommendations = []
         
         try:
-            new_releases = client.new_releases()
+            new_releases_future = upstream_executor.submit(client.new_releases)
+            chart_future = upstream_executor.submit(client.chart, 'world')
+            
+            new_releases = new_releases_future.result(timeout=RECOMMENDATIONS_DEADLINE)
             if new_releases and hasattr(new_releases, 'new_releases'):
                 for album in new_releases.new_releases[:3]:
                     recommendations.append({
@@ -613,7 +1830,7 @@ class EnhancedRecommender:
                         'cover_uri': f"https://{album.cover_uri.replace('%%', '300x300')}" if hasattr(album, 'cover_uri') and album.cover_uri else None,
                         'source': 'new_releases'
                     })
-            chart = client.chart('world')
+            chart = chart_future.result(timeout=RECOMMENDATIONS_DEADLINE)
             if chart and hasattr(chart, 'chart') and chart.chart.tracks:
                 for track in chart.chart.tracks[:3]:
                     recommendations.append(self._format_track(track, 'chart'))
@@ -626,7 +1843,7 @@ class EnhancedRecommender:
     def _get_vk_recommendations(self, vk_client):
         try:
             recommendations = []
-            vk_recs = vk_client.audio.getRecommendations(count=6)
+            vk_recs = vk_client.audio.getRecommendations(count=30)
             
             if 'items' in vk_recs:
                 for track in vk_recs['items']:
@@ -676,7 +1893,7 @@ class EnhancedRecommender:
             'source': source
         }
     
-    def _deduplicate_and_shuffle(self, recommendations):
+    def _deduplicate(self, recommendations):
         seen_ids = set()
         unique_recommendations = []
         
@@ -685,8 +1902,7 @@ class EnhancedRecommender:
                 seen_ids.add(rec['id'])
                 unique_recommendations.append(rec)
         
-        random.shuffle(unique_recommendations)
-        return unique_recommendations[:8]  
+        return unique_recommendations
 
 recommender = EnhancedRecommender()
 
@@ -719,29 +1935,28 @@ def register():
         if len(password) < 6:
             return render_template('auth.html', mode='register', error='Пароль должен содержать минимум 6 символов')
         
-        db = get_db()
-        cursor = db.cursor()
+        conn = get_db()
         
         if not verification_code:
-            cursor.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email))
-            existing_user = cursor.fetchone()
+            existing_user = conn.execute(
+                db.text('SELECT id FROM users WHERE username = :username OR email = :email'),
+                {'username': username, 'email': email}
+            ).fetchone()
             
             if existing_user:
                 return render_template('auth.html', mode='register', error='Пользователь с таким именем или email уже существует')
         
         if verification_code:
-            cursor.execute(
-                'SELECT * FROM users WHERE email = ? AND verification_code = ? AND verification_code_expires > datetime("now")',
-                (email, verification_code)
-            )
-            user_to_verify = cursor.fetchone()
+            user_to_verify = conn.execute(
+                db.text(f'SELECT {USER_COLUMNS} FROM users WHERE email = :email AND verification_code = :code AND verification_code_expires > :now'),
+                {'email': email, 'code': verification_code, 'now': datetime.now()}
+            ).fetchone()
             
             if not user_to_verify:
-                cursor.execute(
-                    'SELECT verification_code_expires FROM users WHERE email = ?',
-                    (email,)
-                )
-                expired_user = cursor.fetchone()
+                expired_user = conn.execute(
+                    db.text('SELECT verification_code_expires FROM users WHERE email = :email'),
+                    {'email': email}
+                ).fetchone()
                 
                 error_msg = 'Неверный или просроченный код подтверждения'
                 if expired_user and expired_user[0]:
@@ -752,11 +1967,11 @@ def register():
                 return render_template('auth.html', mode='register_verify', email=email, 
                                     error=error_msg)
             
-            cursor.execute(
-                'UPDATE users SET email_verified = TRUE, verification_code = NULL, verification_code_expires = NULL WHERE id = ?',
-                (user_to_verify[0],)
+            conn.execute(
+                db.text('UPDATE users SET email_verified = TRUE, verification_code = NULL, verification_code_expires = NULL WHERE id = :id'),
+                {'id': user_to_verify[0]}
             )
-            db.commit()
+            conn.commit()
             
             session.permanent = True
             session['user_id'] = user_to_verify[0]
@@ -770,21 +1985,28 @@ def register():
             password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
             
             try:
-                cursor.execute(
-                    'INSERT INTO users (username, display_name, email, password_hash, verification_code, verification_code_expires) VALUES (?, ?, ?, ?, ?, ?)',
-                    (username, display_name or username, email, password_hash, verification_code, code_expires)
-                )
-                
-                user_id = cursor.lastrowid
-                cursor.execute('INSERT INTO user_settings (user_id) VALUES (?)', (user_id,))
-                db.commit()
+                user_id = conn.execute(db.text('''
+                    INSERT INTO users (username, display_name, email, password_hash, verification_code, verification_code_expires)
+                    VALUES (:username, :display_name, :email, :password_hash, :code, :expires)
+                    RETURNING id
+                '''), {
+                    'username': username,
+                    'display_name': display_name or username,
+                    'email': email,
+                    'password_hash': password_hash,
+                    'code': verification_code,
+                    'expires': code_expires
+                }).scalar()
+                conn.execute(db.text('INSERT INTO user_settings (user_id) VALUES (:user_id)'), {'user_id': user_id})
+                conn.commit()
                 
                 if send_verification_email(email, verification_code):
                     return render_template('auth.html', mode='register_verify', email=email, 
                                         message='Код подтверждения отправлен на вашу почту')
                 else:
                     return render_template('auth.html', mode='register', error='Ошибка отправки email. Попробуйте позже.')
-            except sqlite3.IntegrityError:
+            except IntegrityError:
+                conn.rollback()
                 return render_template('auth.html', mode='register', error='Пользователь с таким именем или email уже существует')
     
     return render_template('auth.html', mode='register')
@@ -800,17 +2022,20 @@ def login():
         if not username or not password:
             return render_template('auth.html', mode='login', error='Введите имя пользователя и пароль')
         
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM users WHERE username = ? OR email = ?', (username, username))
-        user = cursor.fetchone()
+        conn = get_db()
+        user = conn.execute(
+            db.text(f'SELECT {USER_COLUMNS} FROM users WHERE username = :login OR email = :login'),
+            {'login': username}
+        ).fetchone()
         
         if not user or not bcrypt.checkpw(password.encode('utf-8'), user[4].encode('utf-8')):
             return render_template('auth.html', mode='login', error='Неверное имя пользователя или пароль')
         
         if not user[9]:
-            cursor.execute('SELECT verification_code_expires FROM users WHERE id = ?', (user[0],))
-            expiry = cursor.fetchone()
+            expiry = conn.execute(
+                db.text('SELECT verification_code_expires FROM users WHERE id = :id'),
+                {'id': user[0]}
+            ).fetchone()
             
             if expiry and expiry[0]:
                 expiry_time = expiry[0] if isinstance(expiry[0], datetime) else datetime.fromisoformat(expiry[0])
@@ -847,41 +2072,132 @@ def get_currency_balance():
         logger.error(f"Currency balance error: {e}")
         return jsonify({'error': str(e)}), 500
 
+# Каталог магазина меняется только через админку, поэтому держится в памяти готовым к отдаче:
+# data уже разобран из JSON, предметы проиндексированы по id, типу и категории.
+# Снимок не изменяется — при правке каталога строится новый (bump_shop_catalog)
+SHOP_CATALOG_TTL = 300
+
+ShopCatalog = namedtuple('ShopCatalog', ['version', 'etag', 'built_at', 'items', 'by_id', 'by_type', 'by_category'])
+
+_shop_catalog = None
+_shop_catalog_version = 0
+_shop_catalog_lock = threading.Lock()
+
+def build_shop_catalog(version):
+    items = ShopItem.query.options(db.joinedload(ShopItem.category)).order_by(ShopItem.id).all()
+    
+    entries = tuple(MappingProxyType({
+        'id': item.id,
+        'name': item.name,
+        'type': item.type,
+        'category': item.category.name if item.category else 'unknown',
+        'price': item.price,
+        'data': item.get_data_dict(),
+        'rarity': item.rarity
+    }) for item in items)
+    
+    by_type = {}
+    by_category = {}
+    for entry in entries:
+        by_type.setdefault(entry['type'], []).append(entry)
+        by_category.setdefault(entry['category'], []).append(entry)
+    
+    return ShopCatalog(
+        version=version,
+        etag=hashlib.sha256(json.dumps([dict(entry) for entry in entries], sort_keys=True).encode('utf-8')).hexdigest(),
+        built_at=time.monotonic(),
+        items=entries,
+        by_id=MappingProxyType({entry['id']: entry for entry in entries}),
+        by_type=MappingProxyType({key: tuple(value) for key, value in by_type.items()}),
+        by_category=MappingProxyType({key: tuple(value) for key, value in by_category.items()})
+    )
+
+def get_shop_catalog():
+    """Текущий снимок каталога; перестраивается после bump_shop_catalog() или по TTL.
+    
+    TTL нужен другим процессам: версия поднимается только в том, где правили каталог.
+    """
+    global _shop_catalog
+    catalog = _shop_catalog
+    if catalog and catalog.version == _shop_catalog_version and time.monotonic() - catalog.built_at < SHOP_CATALOG_TTL:
+        return catalog
+    
+    with _shop_catalog_lock:
+        catalog = _shop_catalog
+        if not catalog or catalog.version != _shop_catalog_version or time.monotonic() - catalog.built_at >= SHOP_CATALOG_TTL:
+            catalog = _shop_catalog = build_shop_catalog(_shop_catalog_version)
+        return catalog
+
+def bump_shop_catalog():
+    """Отметить каталог измененным; новый снимок построится при следующем чтении"""
+    global _shop_catalog_version
+    with _shop_catalog_lock:
+        _shop_catalog_version += 1
+
+def get_owned_item_ids(user_id):
+    return {
+        item_id for (item_id,) in
+        db.session.query(UserInventory.item_id).filter_by(user_id=user_id)
+    }
+
 @app.route('/api/shop/items')
 @login_required
 def get_shop_items():
     try:
-        user = User.get_current()
-        if not user:
+        user_id = get_current_user_id()
+        if not user_id:
             return jsonify({'error': 'User not found'}), 404
         
-        items = ShopItem.query.all()
-        
-        user_items = user.get_inventory()
-        owned_item_ids = [ui.item_id for ui in user_items]
-        
-        result = []
-        for item in items:
-            result.append({
-                'id': item.id,
-                'name': item.name,
-                'type': item.type,
-                'category': item.category.name if item.category else 'unknown',
-                'price': item.price,
-                'data': item.get_data_dict(),
-                'rarity': item.rarity,
-                'owned': item.id in owned_item_ids
-            })
+        catalog = get_shop_catalog()
+        owned_item_ids = get_owned_item_ids(user_id)
         
-        return jsonify(result)
-    except Exception as e:
-        logger.error(f"Shop items error: {e}")
-        return jsonify({'error': str(e)}), 500
+        result = [
+            {**item, 'owned': item['id'] in owned_item_ids}
+            for item in catalog.items
+        ]
         
-        return jsonify(result)
+        # Ответ зависит и от каталога, и от купленных предметов пользователя
+        response = jsonify(result)
+        response.set_etag(hashlib.sha256(
+            f"{catalog.etag}:{','.join(map(str, sorted(owned_item_ids)))}".encode('utf-8')
+        ).hexdigest())
+        return response.make_conditional(request)
     except Exception as e:
         logger.error(f"Shop items error: {e}")
         return jsonify({'error': str(e)}), 500
+
+def purchase_item(user_id, item):
+    """Купить предмет одной короткой транзакцией.
+    
+    Списание — условный UPDATE, поэтому параллельные покупки не уводят баланс в минус,
+    а повторную покупку отсекает уникальный индекс (user_id, item_id).
+    Возвращает новый баланс, 'owned' или 'insufficient'.
+    """
+    try:
+        db.session.add(UserInventory(user_id=user_id, item_id=item.id))
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return 'owned'
+    
+    new_balance = db.session.execute(
+        db.update(UserCurrency)
+        .where(UserCurrency.user_id == user_id, UserCurrency.balance >= item.price)
+        .values(balance=UserCurrency.balance - item.price, updated_at=datetime.utcnow())
+        .returning(UserCurrency.balance)
+    ).scalar_one_or_none()
+    if new_balance is None:
+        db.session.rollback()
+        return 'insufficient'
+    
+    db.session.add(CurrencyTransaction(
+        user_id=user_id,
+        amount=-item.price,
+        reason=f'purchase_{item.name}'
+    ))
+    db.session.commit()
+    return new_balance
+
 @app.route('/api/shop/buy/<int:item_id>', methods=['POST'])
 @login_required
 def buy_shop_item(item_id):
@@ -890,49 +2206,25 @@ def buy_shop_item(item_id):
         if not user_id:
             return jsonify({'error': 'User not found'}), 404
             
-        item = ShopItem.query.get_or_404(item_id)
+        item = db.session.get(ShopItem, item_id)
+        if not item:
+            return jsonify({'success': False, 'message': 'Товар не найден'}), 404
         
         if not item.is_active:
             return jsonify({'success': False, 'message': 'Товар недоступен'}), 400
         
-        currency = UserCurrency.query.filter_by(user_id=user_id).first()
-        balance = currency.balance if currency else 0
-        
-        if balance < item.price:
-            return jsonify({'success': False, 'message': 'Недостаточно средств'}), 400
-        
-        existing_inventory = UserInventory.query.filter_by(
-            user_id=user_id, item_id=item_id
-        ).first()
-        
-        if existing_inventory:
+        result = purchase_item(user_id, item)
+        if result == 'owned':
             return jsonify({'success': False, 'message': 'Товар уже куплен'}), 400
+        if result == 'insufficient':
+            return jsonify({'success': False, 'message': 'Недостаточно средств'}), 400
         
-        if currency:
-            currency.balance -= item.price
-        else:
-            currency = UserCurrency(user_id=user_id, balance=-item.price)
-            db.session.add(currency)
-        
-        transaction = CurrencyTransaction(
-            user_id=user_id,
-            amount=-item.price,
-            reason=f'purchase_{item.name}'
-        )
-        db.session.add(transaction)
-        
-        inventory = UserInventory(
-            user_id=user_id,
-            item_id=item_id
-        )
-        db.session.add(inventory)
-        
-        db.session.commit()
+        forget_equipped_items(user_id)
         
         return jsonify({
             'success': True, 
             'message': 'Покупка совершена успешно',
-            'new_balance': currency.balance
+            'new_balance': result
         })
         
     except Exception as e:
@@ -948,27 +2240,19 @@ def equip_item(item_id):
         if not user_id:
             return jsonify({'error': 'User not found'}), 404
         
-        inventory_item = UserInventory.query.filter_by(
+        inventory_item = UserInventory.query.options(db.joinedload(UserInventory.item)).filter_by(
             user_id=user_id, item_id=item_id
         ).first()
         
         if not inventory_item:
             return jsonify({'success': False, 'message': 'Товар не куплен'}), 400
         
-        item = ShopItem.query.get_or_404(item_id)
-        
-        same_type_items = db.session.query(UserInventory).join(
-            ShopItem, UserInventory.item_id == ShopItem.id
-        ).filter(
-            UserInventory.user_id == user_id,
-            ShopItem.type == item.type
-        ).all()
-        
-        for inv_item in same_type_items:
-            inv_item.equipped = False
-        
-        inventory_item.equipped = True
+        unequip_items(user_id, inventory_item.item.type)
+        UserInventory.query.filter_by(id=inventory_item.id).update(
+            {'equipped': True}, synchronize_session=False
+        )
         db.session.commit()
+        forget_equipped_items(user_id)
         
         return jsonify({'success': True, 'message': 'Предмет применен'})
         
@@ -981,20 +2265,23 @@ def equip_item(item_id):
 @login_required
 def get_user_inventory():
     try:
-        user = User.get_current()
-        if not user:
+        user_id = get_current_user_id()
+        if not user_id:
             return jsonify({'error': 'User not found'}), 404
         
-        inventory = user.get_inventory()
+        inventory = UserInventory.query.options(db.joinedload(UserInventory.item)).filter_by(user_id=user_id).all()
+        catalog = get_shop_catalog()
         
         result = []
         for inv in inventory:
+            # data берется из каталога, где он уже разобран
+            catalog_item = catalog.by_id.get(inv.item_id)
             result.append({
                 'id': inv.item.id,
                 'name': inv.item.name,
                 'type': inv.item.type,
                 'price': inv.item.price,
-                'data': inv.item.get_data_dict(),
+                'data': catalog_item['data'] if catalog_item else inv.item.get_data_dict(),
                 'equipped': inv.equipped,
                 'purchased_at': inv.purchased_at.isoformat() if inv.purchased_at else None
             })
@@ -1020,12 +2307,7 @@ def admin_add_currency():
         if not target_user:
             return jsonify({'success': False, 'message': 'Пользователь не найден'}), 404
         
-        currency = UserCurrency.query.filter_by(user_id=target_user.id).first()
-        if currency:
-            currency.balance += amount
-        else:
-            currency = UserCurrency(user_id=target_user.id, balance=amount)
-            db.session.add(currency)
+        credit_currency(target_user.id, amount)
         
         transaction = CurrencyTransaction(
             user_id=target_user.id,
@@ -1072,6 +2354,7 @@ def admin_add_shop_item():
         
         db.session.add(new_item)
         db.session.commit()
+        bump_shop_catalog()
         
         return jsonify({
             'success': True,
@@ -1109,6 +2392,7 @@ def manage_shop_categories():
             
             db.session.add(new_category)
             db.session.commit()
+            bump_shop_catalog()
             
             return jsonify({
                 'success': True,
@@ -1124,7 +2408,7 @@ def manage_shop_categories():
 @login_required
 def admin_panel():
     user = get_current_user()
-    if not user or not user[10]: 
+    if not user or not user.is_admin: 
         return redirect(url_for('index'))
     return render_template('admin_panel.html')
 
@@ -1147,21 +2431,16 @@ def profile():
             avatar_file = data.get('avatar_file', '')
             
             user = get_current_user()
-            db = get_db()
-            cursor = db.cursor()
             
-            update_fields = []
-            update_values = []
+            update_fields = {}
             
             if display_name is not None:
-                update_fields.append('display_name = ?')
-                update_values.append(display_name)
+                update_fields['display_name'] = display_name
             
             if bio is not None:
-                update_fields.append('bio = ?')
-                update_values.append(bio)
+                update_fields['bio'] = bio
             
-            final_avatar_url = user[7] if user[7] else ''
+            final_avatar_url = user.avatar_url if user.avatar_url else ''
             if avatar_file and avatar_file.startswith('data:image/'):
                 try:
                     header, encoded = avatar_file.split(',', 1)
@@ -1170,29 +2449,29 @@ def profile():
                     saved_path = save_uploaded_file(file_data, 'avatar')
                     if saved_path:
                         final_avatar_url = saved_path
-                        update_fields.append('avatar_url = ?')
-                        update_values.append(saved_path)
+                        update_fields['avatar_url'] = saved_path
                 except Exception as e:
                     logger.error(f"Error processing avatar file: {e}")
             
             elif avatar_url and avatar_url.startswith(('http://', 'https://')):
                 final_avatar_url = avatar_url
-                update_fields.append('avatar_url = ?')
-                update_values.append(avatar_url)
+                update_fields['avatar_url'] = avatar_url
             
             if yandex_token:
-                update_fields.append('yandex_token = ?')
-                update_values.append(yandex_token)
+                update_fields['yandex_token'] = yandex_token
             
             if vk_token:
-                update_fields.append('vk_token = ?')
-                update_values.append(vk_token)
+                update_fields['vk_token'] = vk_token
             
             if update_fields:
-                update_values.append(user[0])
-                query = f'UPDATE users SET {", ".join(update_fields)}, updated_at = CURRENT_TIMESTAMP WHERE id = ?'
-                cursor.execute(query, update_values)
-                db.commit()
+                assignments = ', '.join(f'{name} = :{name}' for name in update_fields)
+                conn = get_db()
+                conn.execute(
+                    db.text(f'UPDATE users SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = :id'),
+                    {**update_fields, 'id': user.id}
+                )
+                conn.commit()
+                forget_current_user()
             
             return jsonify({
                 'success': True, 
@@ -1209,8 +2488,8 @@ def profile():
 def get_profile_api():
     try:
         user = get_current_user()
-        client = get_yandex_client(user[0])
-        vk_client = get_vk_client(user[0])
+        client = get_yandex_client(user.id)
+        vk_client = get_vk_client(user.id)
         
         yandex_profile = None
         vk_profile = None
@@ -1242,14 +2521,14 @@ def get_profile_api():
         
         return jsonify({
             'local': {
-                'username': user[1],
-                'display_name': user[2] or user[1],
-                'email': user[3],
-                'bio': user[8],
-                'avatar_url': user[7],
-                'yandex_token_set': bool(user[5]),
-                'vk_token_set': bool(user[6]),
-                'created_at': user[12]
+                'username': user.username,
+                'display_name': user.display_name or user.username,
+                'email': user.email,
+                'bio': user.bio,
+                'avatar_url': user.avatar_url,
+                'yandex_token_set': bool(user.yandex_token),
+                'vk_token_set': bool(user.vk_token),
+                'created_at': user.created_at
             },
             'yandex': yandex_profile,
             'vk': vk_profile
@@ -1258,25 +2537,85 @@ def get_profile_api():
         logger.error(f"Profile API error: {e}")
         return jsonify({'error': str(e)}), 500
 
+# Сколько помнить результат проверки токена (секунды): действующий дольше, недействующий меньше
+TOKEN_CHECK_TTL = 300
+TOKEN_CHECK_NEGATIVE_TTL = 60
+
+def token_check_key(service, token):
+    return f"token_check_{service}_{hashlib.sha256(token.encode('utf-8')).hexdigest()}"
+
+def remember_token_status(service, token, status):
+    ttl = TOKEN_CHECK_TTL if status['valid'] else TOKEN_CHECK_NEGATIVE_TTL
+    cache.set(token_check_key(service, token), {
+        'status': status,
+        'expires_at': time.time() + ttl
+    }, timeout=ttl)
+    return status, ttl
+
+def forget_token_status(service, token):
+    if token:
+        cache.delete(token_check_key(service, token))
+
+def is_token_rejected(error):
+    """Сервис отклонил сам токен (а не просто не ответил)"""
+    if isinstance(error, UnauthorizedError):
+        return True
+    # Код 5 в VK API: авторизация пользователя не удалась
+    return isinstance(error, vk_api.exceptions.ApiError) and error.code == 5
+
+def check_token_status(service, token, validate):
+    """Результат проверки токена из кеша; validate(token) вызывается только при промахе"""
+    cached = cache.get(token_check_key(service, token))
+    if cached:
+        return cached['status'], max(int(cached['expires_at'] - time.time()), 0)
+    
+    try:
+        status = validate(token)
+    except Exception as e:
+        if not is_token_rejected(e):
+            # Сеть, таймаут или 5xx сервиса: ответ не кешируем, следующая проверка пойдет заново
+            logger.warning(f"{service} token check failed: {e}")
+            return {'valid': False, 'message': f'Ошибка подключения: {str(e)}'}, 0
+        status = {'valid': False, 'message': f'Токен недействителен: {str(e)}'}
+    return remember_token_status(service, token, status)
+
+def validate_yandex_token(token):
+    account = yandex_clients.get(token).account_status()
+    return {
+        'valid': True,
+        'message': 'Подключено к Яндекс.Музыке',
+        'account': {
+            'login': account.account.login,
+            'name': f"{getattr(account.account, 'first_name', '')} {getattr(account.account, 'last_name', '')}".strip(),
+            'premium': getattr(account.account, 'premium', False)
+        }
+    }
+
+def validate_vk_token(token):
+    vk_user = vk_clients.get(token).users.get()[0]
+    return {
+        'valid': True,
+        'message': 'Подключено к VK Музыке',
+        'account': {
+            'name': f"{vk_user['first_name']} {vk_user['last_name']}",
+            'uid': vk_user['id']
+        }
+    }
+
+def token_status_response(status, ttl):
+    response = jsonify({**status, 'cache_ttl': ttl})
+    response.headers['Cache-Control'] = f'private, max-age={ttl}'
+    return response
+
 @app.route('/api/check_yandex_token')
 @login_required
 def check_yandex_token():
     try:
         user = get_current_user()
-        if not user or not user[5]:
+        if not user or not user.yandex_token:
             return jsonify({'valid': False, 'message': 'Токен не настроен'})
         
-        client = Client(user[5]).init()
-        account = client.account_status()
-        return jsonify({
-            'valid': True,
-            'message': 'Подключено к Яндекс.Музыке',
-            'account': {
-                'login': account.account.login,
-                'name': f"{getattr(account.account, 'first_name', '')} {getattr(account.account, 'last_name', '')}".strip(),
-                'premium': getattr(account.account, 'premium', False)
-            }
-        })
+        return token_status_response(*check_token_status('yandex', user.yandex_token, validate_yandex_token))
     except Exception as e:
         return jsonify({'valid': False, 'message': f'Ошибка подключения: {str(e)}'})
 
@@ -1285,22 +2624,10 @@ def check_yandex_token():
 def check_vk_token():
     try:
         user = get_current_user()
-        if not user or not user[6]:
+        if not user or not user.vk_token:
             return jsonify({'valid': False, 'message': 'Токен не настроен'})
         
-        vk_client = get_vk_client(user[0])
-        if not vk_client:
-            return jsonify({'valid': False, 'message': 'Ошибка инициализации VK клиента'})
-        
-        vk_user = vk_client.users.get()[0]
-        return jsonify({
-            'valid': True,
-            'message': 'Подключено к VK Музыке',
-            'account': {
-                'name': f"{vk_user['first_name']} {vk_user['last_name']}",
-                'uid': vk_user['id']
-            }
-        })
+        return token_status_response(*check_token_status('vk', normalize_vk_token(user.vk_token), validate_vk_token))
     except Exception as e:
         return jsonify({'valid': False, 'message': f'Ошибка подключения: {str(e)}'})
 
@@ -1316,8 +2643,7 @@ def save_token():
             return jsonify({'success': False, 'message': 'Токен не может быть пустым'})
         
         user = get_current_user()
-        db = get_db()
-        cursor = db.cursor()
+        conn = get_db()
         
         if service == 'yandex':
             try:
@@ -1326,56 +2652,76 @@ def save_token():
             except Exception as e:
                 return jsonify({'success': False, 'message': f'Неверный токен: {str(e)}'})
             
-            cursor.execute(
-                'UPDATE users SET yandex_token = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
-                (token, user[0])
+            yandex_clients.invalidate(user.yandex_token)
+            yandex_clients.put(token, client)
+            forget_token_status('yandex', user.yandex_token)
+            
+            conn.execute(
+                db.text('UPDATE users SET yandex_token = :token, updated_at = CURRENT_TIMESTAMP WHERE id = :id'),
+                {'token': token, 'id': user.id}
             )
-            db.commit()
+            conn.commit()
+            forget_current_user()
+            
+            cache.delete(f'recommendations_{user.id}')
+            cache.delete(f'playlists_{user.id}')
+            cache.delete(f'stats_{user.id}')
             
-            cache.delete(f'recommendations_{user[0]}')
-            cache.delete(f'playlists_{user[0]}')
-            cache.delete(f'stats_{user[0]}')
+            account_info = {
+                'login': account.account.login,
+                'name': f"{getattr(account.account, 'first_name', '')} {getattr(account.account, 'last_name', '')}".strip(),
+                'premium': getattr(account.account, 'premium', False)
+            }
+            remember_token_status('yandex', token, {
+                'valid': True,
+                'message': 'Подключено к Яндекс.Музыке',
+                'account': account_info
+            })
             
             return jsonify({
                 'success': True, 
                 'message': 'Токен успешно сохранен и проверен',
-                'account': {
-                    'login': account.account.login,
-                    'name': f"{getattr(account.account, 'first_name', '')} {getattr(account.account, 'last_name', '')}".strip(),
-                    'premium': getattr(account.account, 'premium', False)
-                }
+                'account': account_info
             })
         
         elif service == 'vk':
             try:
-                if 'access_token=' in token:
-                    match = re.search(r'access_token=([^&]+)', token)
-                    if match:
-                        token = match.group(1)
-                
-                vk_session = vk_api.VkApi(token=token)
-                vk_client = vk_session.get_api()
+                token = normalize_vk_token(token)
+                vk_client = create_vk_client(token)
                 vk_user = vk_client.users.get()[0]
             except Exception as e:
                 return jsonify({'success': False, 'message': f'Неверный токен: {str(e)}'})
             
-            cursor.execute(
-                'UPDATE users SET vk_token = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
-                (token, user[0])
+            if user.vk_token:
+                vk_clients.invalidate(normalize_vk_token(user.vk_token))
+                forget_token_status('vk', normalize_vk_token(user.vk_token))
+            vk_clients.put(token, vk_client)
+            
+            conn.execute(
+                db.text('UPDATE users SET vk_token = :token, updated_at = CURRENT_TIMESTAMP WHERE id = :id'),
+                {'token': token, 'id': user.id}
             )
-            db.commit()
+            conn.commit()
+            forget_current_user()
+            
+            cache.delete(f'recommendations_{user.id}')
+            cache.delete(f'playlists_{user.id}')
+            cache.delete(f'stats_{user.id}')
             
-            cache.delete(f'recommendations_{user[0]}')
-            cache.delete(f'playlists_{user[0]}')
-            cache.delete(f'stats_{user[0]}')
+            account_info = {
+                'name': f"{vk_user['first_name']} {vk_user['last_name']}",
+                'uid': vk_user['id']
+            }
+            remember_token_status('vk', token, {
+                'valid': True,
+                'message': 'Подключено к VK Музыке',
+                'account': account_info
+            })
             
             return jsonify({
                 'success': True, 
                 'message': 'Токен успешно сохранен и проверен',
-                'account': {
-                    'name': f"{vk_user['first_name']} {vk_user['last_name']}",
-                    'uid': vk_user['id']
-                }
+                'account': account_info
             })
         
         return jsonify({'success': False, 'message': 'Неизвестный сервис'})
@@ -1397,6 +2743,8 @@ def clean_inventory():
             db.session.delete(item)
         
         db.session.commit()
+        for user_id in {item.user_id for item in invalid_items}:
+            forget_equipped_items(user_id)
         
         return jsonify({
             'success': True,
@@ -1413,7 +2761,7 @@ def get_recommendations():
         user_id = get_current_user_id()
         service = get_current_music_service(user_id)
         
-        recommendations = recommender.get_enhanced_recommendations(user_id, service)
+        recommendations = recommender.get_recommendations(user_id, service)
         
         return jsonify(recommendations)
     except Exception as e:
@@ -1434,6 +2782,7 @@ def reset_database():
         # Инициализируем данные
         init_shop_data()
         create_admin_user()
+        bump_shop_catalog()
         
         return jsonify({'success': True, 'message': 'База данных полностью пересоздана'})
         
@@ -1448,18 +2797,9 @@ def unequip_all_banners():
         user_id = get_current_user_id()
         
         # Снимаем все баннеры
-        banner_items = db.session.query(UserInventory).join(
-            ShopItem, UserInventory.item_id == ShopItem.id
-        ).filter(
-            UserInventory.user_id == user_id,
-            ShopItem.type == 'profile_banner',
-            UserInventory.equipped == True
-        ).all()
-        
-        for item in banner_items:
-            item.equipped = False
-        
+        unequip_items(user_id, 'profile_banner')
         db.session.commit()
+        forget_equipped_items(user_id)
         
         return jsonify({'success': True, 'message': 'Все баннеры сняты'})
         
@@ -1482,34 +2822,8 @@ def get_playlists():
             if not client:
                 return jsonify({'error': 'Токен Яндекс.Музыки не настроен'}), 400
             
-            playlists = client.users_playlists_list()
-            
-            for playlist in playlists:
-                if hasattr(playlist, 'collective') and playlist.collective:
-                    continue
-                    
-                cover_uri = None
-                if hasattr(playlist, 'cover') and playlist.cover:
-                    if hasattr(playlist.cover, 'uri') and playlist.cover.uri:
-                        cover_uri = f"https://{playlist.cover.uri.replace('%%', '400x400')}"
-                
-                modified_date = None
-                if hasattr(playlist, 'modified') and playlist.modified:
-                    if hasattr(playlist.modified, 'isoformat'):
-                        modified_date = playlist.modified.isoformat()
-                    else:
-                        modified_date = str(playlist.modified)
-                
-                result.append({
-                    'id': f"yandex_{playlist.kind}",
-                    'title': playlist.title,
-                    'track_count': playlist.track_count,
-                    'cover_uri': cover_uri,
-                    'modified': modified_date,
-                    'description': getattr(playlist, 'description', '') or '',
-                    'owner': getattr(playlist.owner, 'login', '') if hasattr(playlist, 'owner') else '',
-                    'service': 'yandex'
-                })
+            sync_yandex_playlists(user_id, client)
+            result = get_library_playlists(user_id, include_collective=False)
         
         elif service == 'vk':
             vk_client = get_vk_client(user_id)
@@ -1634,6 +2948,23 @@ def get_playlist(service, playlist_id):
         logger.error(f"Playlist error: {e}")
         return jsonify({'error': str(e)}), 500
 
+LIKED_PAGE_SIZE = 50
+LIKED_PAGE_MAX = 100
+
+def encode_liked_cursor(revision, offset):
+    return base64.urlsafe_b64encode(f"{revision}:{offset}".encode()).decode().rstrip('=')
+
+def decode_liked_cursor(cursor):
+    """Разобрать курсор в (ревизия, смещение); для пустого или битого курсора — (None, 0)"""
+    if not cursor:
+        return None, 0
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        revision, offset = base64.urlsafe_b64decode(padded).decode().split(':')
+        return int(revision), max(int(offset), 0)
+    except (ValueError, UnicodeDecodeError):
+        return None, 0
+
 @app.route('/api/liked_tracks')
 @login_required
 def get_liked_tracks():
@@ -1641,34 +2972,40 @@ def get_liked_tracks():
         user_id = get_current_user_id()
         service = get_current_music_service(user_id)
         
+        limit = min(max(request.args.get('limit', LIKED_PAGE_SIZE, type=int), 1), LIKED_PAGE_MAX)
+        cursor_revision, offset = decode_liked_cursor(request.args.get('cursor'))
+        
         tracks = []
+        failed = {}
+        total = 0
+        revision = 0
+        reset = False
         
         if service == 'yandex':
             client = get_yandex_client(user_id)
             if not client:
                 return jsonify({'error': 'Токен Яндекс.Музыки не настроен'}), 400
             
-            liked_tracks = client.users_likes_tracks()
+            revision = sync_yandex_likes(user_id, client) or 0
+            total = count_library_tracks(user_id)
+            
+            # Список лайков изменился с момента выдачи курсора — начинаем сначала
+            if cursor_revision is not None and cursor_revision != revision:
+                offset = 0
+                reset = True
+            
+            # Догружаются только треки запрошенной страницы, остальные — в фоне
+            page = get_library_tracks(user_id, offset, limit)
+            missing = [track_id for track_id, track in page if not track]
+            if missing:
+                failed = hydrate_library_tracks(user_id, client, missing)
+                page = get_library_tracks(user_id, offset, limit)
             
-            for track_short in liked_tracks[:100]:
-                try:
-                    track = track_short.fetch_track()
-                    cover_uri = None
-                    if hasattr(track, 'cover_uri') and track.cover_uri:
-                        cover_uri = f"https://{track.cover_uri.replace('%%', '300x300')}"
-                    
-                    tracks.append({
-                        'id': f"yandex_{track.id}",
-                        'title': track.title,
-                        'artists': [artist.name for artist in track.artists],
-                        'album': track.albums[0].title if track.albums else 'Unknown Album',
-                        'duration': track.duration_ms,
-                        'cover_uri': cover_uri,
-                        'year': track.albums[0].year if track.albums and track.albums[0].year else 'Unknown',
-                        'service': 'yandex'
-                    })
-                except Exception as e:
-                    continue
+            for track_id, track in page:
+                if track:
+                    tracks.append(track)
+                else:
+                    failed.setdefault(track_id, 'Трек еще не загружен')
         
         elif service == 'vk':
             vk_client = get_vk_client(user_id)
@@ -1676,7 +3013,8 @@ def get_liked_tracks():
                 return jsonify({'error': 'Токен VK не настроен'}), 400
             
             try:
-                liked_tracks = vk_client.audio.get(count=100)
+                liked_tracks = vk_client.audio.get(count=limit, offset=offset)
+                total = liked_tracks.get('count', 0)
                 if 'items' in liked_tracks:
                     for track in liked_tracks['items']:
                         tracks.append({
@@ -1693,11 +3031,90 @@ def get_liked_tracks():
                 logger.error(f"VK liked tracks error: {e}")
                 return jsonify({'error': str(e)}), 500
         
-        return jsonify(tracks)
+        next_offset = offset + limit
+        return jsonify({
+            'tracks': tracks,
+            'total': total,
+            'revision': revision,
+            'next_cursor': encode_liked_cursor(revision, next_offset) if next_offset < total else None,
+            'reset': reset,
+            'failed': list(failed.keys())
+        })
     except Exception as e:
         logger.error(f"Liked tracks error: {e}")
         return jsonify({'error': str(e)}), 500
 
+def get_yandex_stats(user_id):
+    """Статистика из user_stats; счетчики обновляются при синхронизации медиатеки"""
+    conn = get_db()
+    totals = db.text(
+        'SELECT total_liked_tracks, total_playlists, largest_playlist, recomputed_at FROM user_stats WHERE user_id = :user_id'
+    )
+    
+    row = conn.execute(totals, {'user_id': user_id}).fetchone()
+    if not row or row[3] is None:
+        recompute_user_stats(user_id)
+        row = conn.execute(totals, {'user_id': user_id}).fetchone()
+    elif time.time() - row[3] > STATS_RECOMPUTE_INTERVAL:
+        schedule_stats_recompute(user_id)
+    
+    artist_stats = dict(conn.execute(db.text('''
+        SELECT name, count FROM user_stat_counts
+        WHERE user_id = :user_id AND kind = 'artist'
+        ORDER BY count DESC
+        LIMIT :limit
+    '''), {'user_id': user_id, 'limit': STATS_TOP_ARTISTS}).fetchall())
+        
+    genre_stats = dict(conn.execute(db.text('''
+        SELECT name, count FROM user_stat_counts
+        WHERE user_id = :user_id AND kind = 'genre'
+        ORDER BY count DESC
+        LIMIT :limit
+    '''), {'user_id': user_id, 'limit': STATS_TOP_GENRES}).fetchall())
+        
+    total_artists = conn.execute(
+        db.text("SELECT COUNT(*) FROM user_stat_counts WHERE user_id = :user_id AND kind = 'artist'"),
+        {'user_id': user_id}
+    ).scalar()
+    
+    return {
+        'total_playlists': row[1],
+        'total_liked_tracks': row[0],
+        'largest_playlist': row[2],
+        'total_artists': total_artists,
+        'top_artist': next(iter(artist_stats), 'Неизвестно'),
+        'top_genre': next(iter(genre_stats), 'Неизвестно'),
+        'genre_stats': genre_stats,
+        'artist_stats': artist_stats
+    }
+
+def get_vk_stats(vk_client):
+    """Статистика VK; None, если VK вернул неожиданный ответ"""
+    liked_tracks = vk_client.audio.get(count=50)
+    playlists = vk_client.audio.getPlaylists()
+    
+    if 'items' not in liked_tracks or 'items' not in playlists:
+        return None
+    
+    artist_stats = {}
+    
+    for track in liked_tracks['items']:
+        artist = track['artist']
+        artist_stats[artist] = artist_stats.get(artist, 0) + 1
+    
+    top_artist = max(artist_stats.items(), key=lambda x: x[1], default=('Неизвестно', 0))
+    
+    return {
+        'total_playlists': playlists.get('count', 0),
+        'total_liked_tracks': liked_tracks.get('count', 0),
+        'largest_playlist': max([p['count'] for p in playlists['items']], default=0) if playlists['items'] else 0,
+        'total_artists': len(artist_stats),
+        'top_artist': top_artist[0],
+        'top_genre': 'Неизвестно',
+        'genre_stats': {},
+        'artist_stats': dict(sorted(artist_stats.items(), key=lambda x: x[1], reverse=True)[:5])
+    }
+
 @app.route('/api/stats')
 @login_required
 #@cache.cached(timeout=1800, key_prefix=lambda: f'stats_{session["user_id"]}')
@@ -1707,46 +3124,11 @@ def get_stats():
         service = get_current_music_service(user_id)
         
         if service == 'yandex':
-            client = get_yandex_client(user_id)
-            if not client:
+            if not get_current_user().yandex_token:
                 return jsonify({'error': 'Токен Яндекс.Музыки не настроен'}), 400
             
-            playlists = client.users_playlists_list()
-            liked_tracks = client.users_likes_tracks()
-            
-            genre_stats = {}
-            artist_stats = {}
-            
-            for track_short in liked_tracks[:50]:
-                try:
-                    track = track_short.fetch_track()
-                    
-                    if track.albums and track.albums[0].genre:
-                        genre = track.albums[0].genre
-                        genre_stats[genre] = genre_stats.get(genre, 0) + 1
-                    
-                    for artist in track.artists:
-                        artist_name = artist.name
-                        artist_stats[artist_name] = artist_stats.get(artist_name, 0) + 1
-                        
-                except:
-                    continue
-            
-            top_artist = max(artist_stats.items(), key=lambda x: x[1], default=('Неизвестно', 0))
-            top_genre = max(genre_stats.items(), key=lambda x: x[1], default=('Неизвестно', 0))
-            
-            stats = {
-                'total_playlists': len(playlists),
-                'total_liked_tracks': len(liked_tracks),
-                'largest_playlist': max([p.track_count for p in playlists], default=0),
-                'total_artists': len(artist_stats),
-                'top_artist': top_artist[0],
-                'top_genre': top_genre[0],
-                'genre_stats': genre_stats,
-                'artist_stats': dict(sorted(artist_stats.items(), key=lambda x: x[1], reverse=True)[:5])
-            }
-            
-            return jsonify(stats)
+            # Зеркало медиатеки синхронизируют дашборд и страницы медиатеки, здесь — только чтение
+            return jsonify(get_yandex_stats(user_id))
         
         elif service == 'vk':
             vk_client = get_vk_client(user_id)
@@ -1754,32 +3136,10 @@ def get_stats():
                 return jsonify({'error': 'Токен VK не настроен'}), 400
             
             try:
-                liked_tracks = vk_client.audio.get(count=50)
-                playlists = vk_client.audio.getPlaylists()
-                
-                if 'items' not in liked_tracks or 'items' not in playlists:
+                stats = get_vk_stats(vk_client)
+                if stats is None:
                     return jsonify({'error': 'Invalid VK response'}), 500
                 
-                genre_stats = {}
-                artist_stats = {}
-                
-                for track in liked_tracks['items']:
-                    artist = track['artist']
-                    artist_stats[artist] = artist_stats.get(artist, 0) + 1
-                
-                top_artist = max(artist_stats.items(), key=lambda x: x[1], default=('Неизвестно', 0))
-                
-                stats = {
-                    'total_playlists': playlists.get('count', 0),
-                    'total_liked_tracks': liked_tracks.get('count', 0),
-                    'largest_playlist': max([p['count'] for p in playlists['items']], default=0) if playlists['items'] else 0,
-                    'total_artists': len(artist_stats),
-                    'top_artist': top_artist[0],
-                    'top_genre': 'Неизвестно',
-                    'genre_stats': {},
-                    'artist_stats': dict(sorted(artist_stats.items(), key=lambda x: x[1], reverse=True)[:5])
-                }
-                
                 return jsonify(stats)
             except Exception as e:
                 logger.error(f"VK stats error: {e}")
@@ -1790,29 +3150,101 @@ def get_stats():
     except Exception as e:
         logger.error(f"Stats error: {e}")
         return jsonify({'error': str(e)}), 500
+
+STATS_RANGE_DEFAULT_DAYS = 365
+STATS_TOP_MAX = 100
+
+def parse_stats_range():
+    """Диапазон [start, end) в epoch из параметров from/to (YYYY-MM-DD, UTC, обе даты включительно)"""
+    day = ROLLUP_GRANULARITIES['day']
+    end = int(time.time())
+    if request.args.get('to'):
+        end = calendar.timegm(datetime.strptime(request.args['to'], '%Y-%m-%d').timetuple()) + day
+    
+    start = end - STATS_RANGE_DEFAULT_DAYS * day
+    if request.args.get('from'):
+        start = calendar.timegm(datetime.strptime(request.args['from'], '%Y-%m-%d').timetuple())
+    return start, end
+
+@app.route('/api/stats/top')
+@login_required
+def get_stats_top():
+    """Top-N треков, артистов или жанров за период: ?kind=artist&from=2025-01-01&to=2025-12-31&limit=10"""
+    try:
+        user_id = get_current_user_id()
+        kind = request.args.get('kind', 'artist')
+        if kind not in ROLLUP_KINDS:
+            return jsonify({'error': 'Неизвестный тип статистики'}), 400
+        
+        try:
+            start, end = parse_stats_range()
+        except ValueError:
+            return jsonify({'error': 'Неверный формат даты, ожидается ГГГГ-ММ-ДД'}), 400
+        limit = max(1, min(request.args.get('limit', 10, type=int), STATS_TOP_MAX))
+        
+        schedule_rollup_update()
+        top = get_top_listened(user_id, kind, start, end, limit)
+        
+        items = [{'name': key, 'plays': plays} for key, plays in top]
+        if kind == 'track' and top:
+            track_data = get_tracks(get_db(), [key for key, _ in top])
+            
+            items = [{
+                'id': key,
+                'name': track_data.get(key, {}).get('title', key),
+                'artists': track_data.get(key, {}).get('artists', []),
+                'cover_uri': track_data.get(key, {}).get('cover_uri'),
+                'plays': plays
+            } for key, plays in top]
+        
+        return jsonify({
+            'kind': kind,
+            'from': datetime.utcfromtimestamp(start).date().isoformat(),
+            'to': datetime.utcfromtimestamp(end - 1).date().isoformat(),
+            'items': items
+        })
+    except Exception as e:
+        logger.error(f"Stats top error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/stats/timeline')
+@login_required
+def get_stats_timeline():
+    """Число прослушиваний по дням (или часам за последние две недели) для графиков"""
+    try:
+        user_id = get_current_user_id()
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in ROLLUP_GRANULARITIES:
+            return jsonify({'error': 'Неизвестная детализация'}), 400
+        
+        try:
+            start, end = parse_stats_range()
+        except ValueError:
+            return jsonify({'error': 'Неверный формат даты, ожидается ГГГГ-ММ-ДД'}), 400
+        
+        schedule_rollup_update()
+        points = get_listen_timeline(user_id, start, end, granularity)
+        
+        return jsonify({
+            'granularity': granularity,
+            'points': [
+                {'bucket': datetime.utcfromtimestamp(bucket).isoformat(), 'plays': plays}
+                for bucket, plays in points
+            ]
+        })
+    except Exception as e:
+        logger.error(f"Stats timeline error: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/profile/equipped')
 @login_required
 def get_equipped_items():
     try:
-        user = User.get_current()
-        if not user:
+        user_id = get_current_user_id()
+        if not user_id:
             return jsonify({'error': 'User not found'}), 404
         
-        inventory = UserInventory.query.filter_by(
-            user_id=user.id, equipped=True
-        ).all()
-        
-        equipped_items = {}
-        for inv_item in inventory:
-            equipped_items[inv_item.item.type] = {
-                'item_id': inv_item.item_id,
-                'name': inv_item.item.name,
-                'type': inv_item.item.type,
-                'data': inv_item.item.get_data_dict(),
-                'purchased_at': inv_item.purchased_at.isoformat() if inv_item.purchased_at else None
-            }
-        
-        return jsonify(equipped_items)
+        return jsonify(load_equipped_items(user_id))
     except Exception as e:
         logger.error(f"Equipped items error: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1920,165 +3352,379 @@ def search():
         logger.error(f"Search error: {e}")
         return jsonify({'error': str(e)}), 500
 
+# Сколько живет прямая ссылка в кеше (секунды); подписанные ссылки сервисов действуют ограниченное время
+DIRECT_LINK_TTL = {'yandex': 600, 'vk': 3600}
+DIRECT_LINK_SAFETY_MARGIN = 60
+
+def direct_link_ttl(service, url):
+    """Время жизни ссылки в кеше с запасом до истечения подписи"""
+    ttl = DIRECT_LINK_TTL.get(service, 300)
+    expires = parse_qs(urlparse(url).query).get('expires')
+    if expires:
+        try:
+            ttl = min(ttl, int(expires[0]) - time.time())
+        except ValueError:
+            pass
+    return int(ttl - DIRECT_LINK_SAFETY_MARGIN)
+
+def resolve_yandex_stream(client, track_id):
+    """Трек, информация о загрузке и прямая ссылка — три запроса к API"""
+    track = client.tracks(track_id)[0]
+    
+    download_info = track.get_download_info()
+    if not download_info:
+        return None
+    
+    best_quality = max(download_info, key=lambda x: x.bitrate_in_kbps)
+    download_url = best_quality.get_direct_link()
+    
+    track_data = {
+        'title': track.title,
+        'artists': [artist.name for artist in track.artists],
+        'album': track.albums[0].title if track.albums else 'Unknown Album',
+        'genre': track.albums[0].genre if track.albums and track.albums[0].genre else 'Unknown',
+        'duration': track.duration_ms,
+        'cover_uri': f"https://{track.cover_uri.replace('%%', '300x300')}" if track.cover_uri else None
+    }
+    
+    return {
+        'url': download_url,
+        'title': track.title,
+        'artists': track_data['artists'],
+        'duration': track.duration_ms,
+        'cover_uri': track_data['cover_uri'],
+        'service': 'yandex',
+        'track_data': track_data
+    }
+
+def resolve_vk_stream(vk_client, track_id):
+    track_info = vk_client.audio.getById(audios=track_id)
+    if not track_info or 'url' not in track_info[0]:
+        return None
+    
+    track = track_info[0]
+    cover_uri = track.get('album', {}).get('thumb', {}).get('photo_300') if track.get('album') else None
+    
+    return {
+        'url': track['url'],
+        'title': track['title'],
+        'artists': [track['artist']],
+        'duration': track['duration'] * 1000,
+        'cover_uri': cover_uri,
+        'service': 'vk',
+        'track_data': {
+            'title': track['title'],
+            'artists': [track['artist']],
+            'album': track.get('album', {}).get('title', 'Unknown Album'),
+            'genre': 'Unknown',
+            'duration': track['duration'] * 1000,
+            'cover_uri': cover_uri
+        }
+    }
+
+def stream_cache_key(service, token, track_id):
+    """Ссылка зависит от аккаунта: бесплатный Яндекс отдает 30-секундный фрагмент,
+    Plus — полный файл, а ссылки VK выдаются на конкретный токен
+    """
+    token_hash = hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+    return f'track_url_{service}_{token_hash}_{track_id}'
+
+def stream_token(user, service):
+    return user.yandex_token if service == 'yandex' else normalize_vk_token(user.vk_token)
+
+def get_cached_stream(service, token, track_id):
+    return cache.get(stream_cache_key(service, token, track_id))
+
+def cache_stream(service, token, track_id, stream):
+    ttl = direct_link_ttl(service, stream['url'])
+    if ttl > 0:
+        cache.set(stream_cache_key(service, token, track_id), stream, timeout=ttl)
+
+# Прослушивания пишутся в базу фоновым потоком пачками, чтобы ответ с адресом трека
+# не ждал записи. Очередь ограничена: при переполнении события отбрасываются и считаются
+LISTEN_QUEUE_SIZE = 10000
+LISTEN_BATCH_SIZE = 500
+LISTEN_FLUSH_INTERVAL = 1.0
+LISTEN_SHUTDOWN_TIMEOUT = 10
+
+def write_listens(events):
+    """Записать пачку прослушиваний одной транзакцией: справочник треков, события и награды.
+    
+    Счетчики user_stat_counts считают только лайки (доли жанров в /api/stats берутся от
+    total_liked_tracks); прослушивания учитываются в listen_rollups.
+    """
+    conn = get_db()
+    
+    track_ids = save_tracks(conn, {
+        f"{service}_{track_id}": track_data
+        for _, service, track_id, track_data, _ in events
+    })
+    conn.execute(db.text('INSERT INTO play_events (user_id, track_id, played_at) VALUES (:user_id, :track_id, :played_at)'), [
+        {'user_id': user_id, 'track_id': track_ids[f"{service}_{track_id}"], 'played_at': played_at}
+        for user_id, service, track_id, _, played_at in events
+    ])
+    
+    rewards = Counter()
+    for user_id, service, _, _, _ in events:
+        if service == 'yandex':
+            rewards[user_id] += 1
+    conn.commit()
+    
+    try:
+        for user_id, amount in rewards.items():
+            credit_currency(user_id, amount)
+            db.session.add(CurrencyTransaction(user_id=user_id, amount=amount, reason='listen_track', entries=amount))
+        db.session.commit()
+    except Exception as e:
+        logger.error(f"Listen rewards error: {e}")
+        db.session.rollback()
+    
+    for user_id in {event[0] for event in events}:
+        recommender.note_listen(user_id)
+
+class ListenWriter:
+    """Очередь прослушиваний с фоновым потоком записи"""
+    
+    def __init__(self, max_size=LISTEN_QUEUE_SIZE, batch_size=LISTEN_BATCH_SIZE):
+        self._queue = queue.Queue(maxsize=max_size)
+        self._batch_size = batch_size
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+    
+    def put(self, event):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning("Listen queue is full, dropping listen event")
+    
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='listen-writer', daemon=True)
+                self._thread.start()
+    
+    def _next_batch(self, timeout):
+        """Дождаться первого события и добрать пачку без ожидания; None — сигнал остановки"""
+        try:
+            event = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return []
+        if event is None:
+            return None
+        
+        batch = [event]
+        while len(batch) < self._batch_size:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is None:
+                self._queue.put(None)
+                break
+            batch.append(event)
+        return batch
+    
+    def _run(self):
+        while True:
+            batch = self._next_batch(LISTEN_FLUSH_INTERVAL)
+            if batch is None:
+                return
+            if batch:
+                self._write(batch)
+    
+    def _write(self, batch):
+        try:
+            with app.app_context():
+                write_listens(batch)
+            with self._lock:
+                self.written += len(batch)
+        except Exception as e:
+            logger.error(f"Listen batch write error: {e}")
+            with self._lock:
+                self.failed += len(batch)
+    
+    def stop(self, timeout=LISTEN_SHUTDOWN_TIMEOUT):
+        """Дописать все, что в очереди, и остановить поток"""
+        with self._lock:
+            thread = self._thread
+        if thread is None:
+            return
+        
+        self._queue.put(None)
+        thread.join(timeout)
+        if thread.is_alive():
+            logger.warning(f"Listen writer did not finish in {timeout}s, {self._queue.qsize()} events left")
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed
+            }
+
+listen_writer = ListenWriter()
+atexit.register(listen_writer.stop)
+
+def record_listen(user_id, service, track_id, track_data):
+    """Поставить прослушивание в очередь записи"""
+    listen_writer.put((user_id, service, track_id, track_data, int(time.time())))
+
 @app.route('/api/play_track/<service>_<track_id>')
 @login_required
 def get_track_url(service, track_id):
     try:
-        user_id = get_current_user_id()
+        user = get_current_user()
+        user_id = user.id
         
-        if service == 'yandex':
+        if service not in ('yandex', 'vk'):
+            return jsonify({'error': 'Неизвестный сервис'}), 400
+        
+        if service == 'yandex' and not user.yandex_token:
+            return jsonify({'error': 'Токен Яндекс.Музыки не настроен'}), 400
+        if service == 'vk' and not user.vk_token:
+            return jsonify({'error': 'Токен VK не настроен'}), 400
+        
+        token = stream_token(user, service)
+        stream = get_cached_stream(service, token, track_id)
+        
+        if not stream and service == 'yandex':
             client = get_yandex_client(user_id)
             if not client:
                 return jsonify({'error': 'Токен Яндекс.Музыки не настроен'}), 400
             
-            track = client.tracks(track_id)[0]
-            
-            download_info = track.get_download_info()
-            
-            if not download_info:
+            stream = resolve_yandex_stream(client, track_id)
+            if not stream:
                 return jsonify({'error': 'Не удалось получить информацию для скачивания'}), 404
+            cache_stream(service, token, track_id, stream)
             
-            best_quality = max(download_info, key=lambda x: x.bitrate_in_kbps)
-            download_url = best_quality.get_direct_link()
-            
-            track_data = {
-                'title': track.title,
-                'artists': [artist.name for artist in track.artists],
-                'album': track.albums[0].title if track.albums else 'Unknown Album',
-                'genre': track.albums[0].genre if track.albums and track.albums[0].genre else 'Unknown',
-                'duration': track.duration_ms,
-                'cover_uri': f"https://{track.cover_uri.replace('%%', '300x300')}" if track.cover_uri else None
-            }
-            
-            db = get_db()
-            cursor = db.cursor()
-            
-            cursor.execute(
-                'INSERT INTO listening_history (user_id, track_id, track_data) VALUES (?, ?, ?)',
-                (user_id, f"yandex_{track_id}", json.dumps(track_data))
-            )
-            
-            activity_data = json.dumps({
-                'track': track.title,
-                'artist': ', '.join([artist.name for artist in track.artists]),
-                'track_id': f"yandex_{track_id}",
-                'service': 'yandex'
-            })
-            cursor.execute(
-                'INSERT INTO user_activity (user_id, activity_type, activity_data) VALUES (?, ?, ?)',
-                (user_id, 'listen', activity_data)
-            )
-            
-            db.commit()
-            add_currency(user_id, 1, 'listen_track')
-            
-            return jsonify({
-                'url': download_url,
-                'title': track.title,
-                'artists': [artist.name for artist in track.artists],
-                'duration': track.duration_ms,
-                'cover_uri': track_data['cover_uri'],
-                'service': 'yandex'
-            })
-        
-        elif service == 'vk':
+        elif not stream and service == 'vk':
             vk_client = get_vk_client(user_id)
             if not vk_client:
                 return jsonify({'error': 'Токен VK не настроен'}), 400
             
             try:
-                track_info = vk_client.audio.getById(audios=track_id)
-                if not track_info or 'url' not in track_info[0]:
-                    return jsonify({'error': 'Не удалось получить информацию о треке'}), 404
-                
-                track_data = track_info[0]
-                
-                db = get_db()
-                cursor = db.cursor()
-                
-                vk_track_data = {
-                    'title': track_data['title'],
-                    'artists': [track_data['artist']],
-                    'album': track_data.get('album', {}).get('title', 'Unknown Album'),
-                    'genre': 'Unknown',
-                    'duration': track_data['duration'] * 1000,
-                    'cover_uri': track_data.get('album', {}).get('thumb', {}).get('photo_300') if track_data.get('album') else None
-                }
-                
-                cursor.execute(
-                    'INSERT INTO listening_history (user_id, track_id, track_data) VALUES (?, ?, ?)',
-                    (user_id, f"vk_{track_id}", json.dumps(vk_track_data))
-                )
-                
-                activity_data = json.dumps({
-                    'track': track_data['title'],
-                    'artist': track_data['artist'],
-                    'track_id': f"vk_{track_id}",
-                    'service': 'vk'
-                })
-                cursor.execute(
-                    'INSERT INTO user_activity (user_id, activity_type, activity_data) VALUES (?, ?, ?)',
-                    (user_id, 'listen', activity_data)
-                )
-                
-                db.commit()
-                
-                return jsonify({
-                    'url': track_data['url'],
-                    'title': track_data['title'],
-                    'artists': [track_data['artist']],
-                    'duration': track_data['duration'] * 1000,
-                    'cover_uri': track_data.get('album', {}).get('thumb', {}).get('photo_300') if track_data.get('album') else None,
-                    'service': 'vk'
-                })
-                
+                stream = resolve_vk_stream(vk_client, track_id)
             except Exception as e:
                 logger.error(f"VK track error: {e}")
                 return jsonify({'error': str(e)}), 500
+            if not stream:
+                return jsonify({'error': 'Не удалось получить информацию о треке'}), 404
+            cache_stream(service, token, track_id, stream)
         
-        return jsonify({'error': 'Неизвестный сервис'}), 400
+        record_listen(user_id, service, track_id, stream['track_data'])
+        
+        return jsonify({key: value for key, value in stream.items() if key != 'track_data'})
         
     except Exception as e:
         logger.error(f"Track URL error: {e}")
         return jsonify({'error': str(e)}), 500
     
+PREFETCH_MAX_TRACKS = 5
+PREFETCH_TIMEOUT = 10
+
+@app.route('/api/prefetch_tracks', methods=['POST'])
+@login_required
+def prefetch_tracks():
+    """Заранее получить ссылки на следующие треки очереди; прослушивание не записывается"""
+    try:
+        data = request.get_json() or {}
+        track_ids = list(dict.fromkeys(data.get('track_ids', [])))[:PREFETCH_MAX_TRACKS]
+        
+        user = get_current_user()
+        clients = {}
+        result = {}
+        failed = []
+        futures = []
+        
+        for full_id in track_ids:
+            service, _, track_id = str(full_id).partition('_')
+            if service not in ('yandex', 'vk') or not track_id:
+                failed.append(full_id)
+                continue
+            if not (user.yandex_token if service == 'yandex' else user.vk_token):
+                failed.append(full_id)
+                continue
+            
+            stream = get_cached_stream(service, stream_token(user, service), track_id)
+            if stream:
+                result[full_id] = stream
+                continue
+            
+            if service not in clients:
+                clients[service] = get_yandex_client(user.id) if service == 'yandex' else get_vk_client(user.id)
+            client = clients[service]
+            if not client:
+                failed.append(full_id)
+                continue
+            
+            resolve = resolve_yandex_stream if service == 'yandex' else resolve_vk_stream
+            futures.append((full_id, service, track_id, upstream_executor.submit(resolve, client, track_id)))
+        
+        for full_id, service, track_id, future in futures:
+            try:
+                stream = future.result(timeout=PREFETCH_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Prefetch {full_id} failed: {e}")
+                stream = None
+            
+            if stream:
+                cache_stream(service, stream_token(user, service), track_id, stream)
+                result[full_id] = stream
+            else:
+                failed.append(full_id)
+        
+        return jsonify({
+            'tracks': {
+                full_id: {key: value for key, value in stream.items() if key != 'track_data'}
+                for full_id, stream in result.items()
+            },
+            'failed': failed
+        })
+    
+    except Exception as e:
+        logger.error(f"Prefetch tracks error: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/settings', methods=['GET', 'POST'])
 @login_required
 def user_settings():
-    db = get_db()
-    cursor = db.cursor()
     user_id = get_current_user_id()
     
     if request.method == 'GET':
-        cursor.execute('SELECT * FROM user_settings WHERE user_id = ?', (user_id,))
-        settings = cursor.fetchone()
-        
-        if settings:
-            return jsonify({
-                'theme': settings[1],
-                'language': settings[2],
-                'auto_play': bool(settings[3]),
-                'show_explicit': bool(settings[4]),
-                'music_service': settings[5]
-            })
-        return jsonify({})
+        return jsonify(get_user_settings(user_id))
     
     elif request.method == 'POST':
         data = request.get_json()
+        settings = {
+            'theme': data.get('theme', 'dark'),
+            'language': data.get('language', 'ru'),
+            'auto_play': bool(data.get('auto_play', True)),
+            'show_explicit': bool(data.get('show_explicit', True)),
+            'music_service': data.get('music_service', 'yandex')
+        }
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO user_settings 
+        conn = get_db()
+        conn.execute(db.text('''
+            INSERT INTO user_settings 
             (user_id, theme, language, auto_play, show_explicit, music_service)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (
-            user_id,
-            data.get('theme', 'dark'),
-            data.get('language', 'ru'),
-            data.get('auto_play', True),
-            data.get('show_explicit', True),
-            data.get('music_service', 'yandex')
-        ))
-        db.commit()
+            VALUES (:user_id, :theme, :language, :auto_play, :show_explicit, :music_service)
+            ON CONFLICT (user_id) DO UPDATE SET
+                theme = excluded.theme,
+                language = excluded.language,
+                auto_play = excluded.auto_play,
+                show_explicit = excluded.show_explicit,
+                music_service = excluded.music_service
+        '''), {'user_id': user_id, **settings})
+        conn.commit()
+        cache.set(f'settings_{user_id}', settings, timeout=SETTINGS_CACHE_TTL)
         
         return jsonify({'success': True})
 
@@ -2096,10 +3742,11 @@ def resend_verification():
         if not email:
             return jsonify({'success': False, 'message': 'Email обязателен'})
         
-        db = get_db()
-        cursor = db.cursor()
-        cursor.execute('SELECT * FROM users WHERE email = ? AND email_verified = FALSE', (email,))
-        user = cursor.fetchone()
+        conn = get_db()
+        user = conn.execute(
+            db.text(f'SELECT {USER_COLUMNS} FROM users WHERE email = :email AND email_verified = FALSE'),
+            {'email': email}
+        ).fetchone()
         
         if not user:
             return jsonify({'success': False, 'message': 'Пользователь не найден или уже подтвержден'})
@@ -2107,11 +3754,11 @@ def resend_verification():
         verification_code = str(uuid.uuid4())[:6].upper()
         code_expires = datetime.now() + timedelta(minutes=10)
         
-        cursor.execute(
-            'UPDATE users SET verification_code = ?, verification_code_expires = ? WHERE id = ?',
-            (verification_code, code_expires, user[0])
+        conn.execute(
+            db.text('UPDATE users SET verification_code = :code, verification_code_expires = :expires WHERE id = :id'),
+            {'code': verification_code, 'expires': code_expires, 'id': user[0]}
         )
-        db.commit()
+        conn.commit()
         
         if send_verification_email(email, verification_code):
             return jsonify({'success': True, 'message': 'Код отправлен повторно'})
@@ -2130,11 +3777,9 @@ def force_resend_verification():
         if not email:
             return jsonify({'success': False, 'message': 'Email обязателен'})
         
-        db = get_db()
-        cursor = db.cursor()
+        conn = get_db()
         
-        cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
-        user = cursor.fetchone()
+        user = conn.execute(db.text(f'SELECT {USER_COLUMNS} FROM users WHERE email = :email'), {'email': email}).fetchone()
         
         if not user:
             return jsonify({'success': False, 'message': 'Пользователь не найден'})
@@ -2142,11 +3787,11 @@ def force_resend_verification():
         verification_code = str(uuid.uuid4())[:6].upper()
         code_expires = datetime.now() + timedelta(minutes=10)
         
-        cursor.execute(
-            'UPDATE users SET verification_code = ?, verification_code_expires = ? WHERE email = ?',
-            (verification_code, code_expires, email)
+        conn.execute(
+            db.text('UPDATE users SET verification_code = :code, verification_code_expires = :expires WHERE email = :email'),
+            {'code': verification_code, 'expires': code_expires, 'email': email}
         )
-        db.commit()
+        conn.commit()
         
         if send_verification_email(email, verification_code):
             return jsonify({'success': True, 'message': 'Новый код отправлен на вашу почту'})
@@ -2162,24 +3807,22 @@ def force_resend_verification():
 def get_friends():
     try:
         user_id = get_current_user_id()
-        db = get_db()
-        cursor = db.cursor()
         
-        cursor.execute('''
+        rows = get_db().execute(db.text('''
             SELECT u.id, u.username, u.display_name, u.avatar_url, 
                    f.status, f.taste_match, f.created_at,
-                   CASE WHEN f.user_id = ? THEN 'outgoing' ELSE 'incoming' END as direction
+                   CASE WHEN f.user_id = :user_id THEN 'outgoing' ELSE 'incoming' END as direction
             FROM friends f
             JOIN users u ON u.id = CASE 
-                WHEN f.user_id = ? THEN f.friend_id 
+                WHEN f.user_id = :user_id THEN f.friend_id 
                 ELSE f.user_id 
             END
-            WHERE (f.user_id = ? OR f.friend_id = ?) 
+            WHERE (f.user_id = :user_id OR f.friend_id = :user_id) 
             AND f.status IN ('accepted', 'pending')
-        ''', (user_id, user_id, user_id, user_id))
+        '''), {'user_id': user_id})
         
         friends = []
-        for row in cursor.fetchall():
+        for row in rows:
             friends.append({
                 'id': row[0],
                 'username': row[1],
@@ -2187,7 +3830,7 @@ def get_friends():
                 'avatar_url': row[3],
                 'status': row[4],
                 'taste_match': row[5],
-                'created_at': row[6],
+                'created_at': str(row[6]) if row[6] else None,
                 'direction': row[7]
             })
         
@@ -2200,34 +3843,32 @@ def get_friends():
 def add_friend(friend_id):
     try:
         user_id = get_current_user_id()
-        db = get_db()
-        cursor = db.cursor()
+        conn = get_db()
         
-        cursor.execute('''
+        existing = conn.execute(db.text('''
             SELECT * FROM friends 
-            WHERE (user_id = ? AND friend_id = ?) 
-            OR (user_id = ? AND friend_id = ?)
-        ''', (user_id, friend_id, friend_id, user_id))
+            WHERE (user_id = :user_id AND friend_id = :friend_id) 
+            OR (user_id = :friend_id AND friend_id = :user_id)
+        '''), {'user_id': user_id, 'friend_id': friend_id}).fetchone()
         
-        existing = cursor.fetchone()
         if existing:
             return jsonify({'error': 'Уже есть запрос на дружбу'}), 400
         
         taste_match = 75
         
-        cursor.execute('''
+        conn.execute(db.text('''
             INSERT INTO friends (user_id, friend_id, taste_match, status)
-            VALUES (?, ?, ?, 'pending')
-        ''', (user_id, friend_id, taste_match))
+            VALUES (:user_id, :friend_id, :taste_match, 'pending')
+        '''), {'user_id': user_id, 'friend_id': friend_id, 'taste_match': taste_match})
         
-        db.commit()
+        conn.commit()
         
-        cursor.execute('''
+        conn.execute(db.text('''
             INSERT INTO user_activity (user_id, activity_type, activity_data)
-            VALUES (?, 'friend', ?)
-        ''', (user_id, json.dumps({'friend_id': friend_id})))
+            VALUES (:user_id, 'friend', :activity_data)
+        '''), {'user_id': user_id, 'activity_data': json.dumps({'friend_id': friend_id})})
         
-        db.commit()
+        conn.commit()
         
         return jsonify({'success': True, 'message': 'Запрос отправлен'})
     except Exception as e:
@@ -2238,25 +3879,24 @@ def add_friend(friend_id):
 def get_user_activity():
     try:
         user_id = get_current_user_id()
-        db = get_db()
-        cursor = db.cursor()
+        conn = get_db()
         
-        cursor.execute('''
+        rows = conn.execute(db.text('''
             SELECT activity_type, activity_data, created_at 
             FROM user_activity 
-            WHERE user_id = ? 
+            WHERE user_id = :user_id 
             ORDER BY created_at DESC 
             LIMIT 20
-        ''', (user_id,))
+        '''), {'user_id': user_id})
         
         activities = []
-        for row in cursor.fetchall():
+        for row in rows:
             activity_type, activity_data, created_at = row
             data = json.loads(activity_data) if activity_data else {}
             
             activity = {
                 'type': activity_type,
-                'timestamp': created_at.isoformat() if hasattr(created_at, 'isoformat') else str(created_at)
+                'timestamp': datetime.fromisoformat(str(created_at)).isoformat()
             }
             
             if activity_type == 'listen':
@@ -2271,7 +3911,28 @@ def get_user_activity():
             
             activities.append(activity)
         
-        return jsonify(activities)
+        # Прослушивания хранятся в play_events, а не в user_activity
+        rows = conn.execute(db.text('''
+            SELECT tracks.track_key, tracks.title, tracks.artists, play_events.played_at
+            FROM play_events
+            JOIN tracks ON tracks.id = play_events.track_id
+            WHERE play_events.user_id = :user_id
+            ORDER BY play_events.played_at DESC
+            LIMIT 20
+        '''), {'user_id': user_id})
+        
+        for track_key, title, artists, played_at in rows:
+            activities.append({
+                'type': 'listen',
+                'timestamp': datetime.utcfromtimestamp(played_at).isoformat(),
+                'track': title or 'Неизвестный трек',
+                'artist': ', '.join(json.loads(artists)) if artists else 'Неизвестный артист',
+                'track_id': track_key,
+                'service': track_key.split('_', 1)[0]
+            })
+        
+        activities.sort(key=lambda activity: activity['timestamp'], reverse=True)
+        return jsonify(activities[:20])
     except Exception as e:
         logger.error(f"User activity error: {e}")
         return jsonify([])
@@ -2279,13 +3940,11 @@ def get_user_activity():
 @app.route('/api/themes', methods=['GET', 'POST'])
 @login_required
 def user_themes():
-    db = get_db()
-    cursor = db.cursor()
+    conn = get_db()
     user_id = get_current_user_id()
     
     if request.method == 'GET':
-        cursor.execute('SELECT * FROM user_themes WHERE user_id = ?', (user_id,))
-        themes = cursor.fetchall()
+        themes = conn.execute(db.text('SELECT * FROM user_themes WHERE user_id = :user_id'), {'user_id': user_id}).fetchall()
         
         # Стандартные пресеты
         default_themes = {
@@ -2351,19 +4010,20 @@ def user_themes():
             return jsonify({'success': False, 'error': 'Отсутствуют обязательные поля: name и colors'}), 400
         
         try:
-            cursor.execute('''
+            theme_id = conn.execute(db.text('''
                 INSERT INTO user_themes (user_id, name, colors, background_url, is_default)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (
-                user_id,
-                data['name'],
-                json.dumps(data['colors']),
-                data.get('background_url'),
-                data.get('is_default', False)
-            ))
-            db.commit()
+                VALUES (:user_id, :name, :colors, :background_url, :is_default)
+                RETURNING id
+            '''), {
+                'user_id': user_id,
+                'name': data['name'],
+                'colors': json.dumps(data['colors']),
+                'background_url': data.get('background_url'),
+                'is_default': bool(data.get('is_default', False))
+            }).scalar()
+            conn.commit()
             
-            return jsonify({'success': True, 'theme_id': cursor.lastrowid})
+            return jsonify({'success': True, 'theme_id': theme_id})
         except Exception as e:
             logger.error(f"Theme creation error: {e}")
             return jsonify({'success': False, 'error': str(e)}), 500
@@ -2371,61 +4031,129 @@ def user_themes():
 @app.route('/api/themes/<int:theme_id>', methods=['DELETE'])
 @login_required
 def delete_theme(theme_id):
-    db = get_db()
-    cursor = db.cursor()
+    conn = get_db()
     user_id = get_current_user_id()
     
-    cursor.execute('DELETE FROM user_themes WHERE id = ? AND user_id = ?', (theme_id, user_id))
-    db.commit()
+    conn.execute(db.text('DELETE FROM user_themes WHERE id = :id AND user_id = :user_id'), {'id': theme_id, 'user_id': user_id})
+    conn.commit()
     
     return jsonify({'success': True})
 
+def get_recent_listens(user_id, limit=10):
+    rows = get_db().execute(db.text(f'''
+        SELECT tracks.track_key, {TRACK_COLUMNS}, play_events.played_at
+        FROM play_events
+        JOIN tracks ON tracks.id = play_events.track_id
+        WHERE play_events.user_id = :user_id
+        ORDER BY play_events.played_at DESC
+        LIMIT :limit
+    '''), {'user_id': user_id, 'limit': limit})
+    
+    history = []
+    for row in rows:
+        track_data = track_from_row(row[1:-1])
+        track_data['id'] = row[0]
+        track_data['played_at'] = datetime.utcfromtimestamp(row[-1]).isoformat()
+        history.append(track_data)
+    return history
+
 @app.route('/api/listening_history')
 @login_required
 def get_listening_history():
     try:
-        user_id = get_current_user_id()
-        db = get_db()
-        cursor = db.cursor()
-        
-        cursor.execute('''
-            SELECT track_data, played_at 
-            FROM listening_history 
-            WHERE user_id = ? 
-            ORDER BY played_at DESC 
-            LIMIT 10
-        ''', (user_id,))
-        
-        history = []
-        for row in cursor.fetchall():
-            try:
-                track_data = json.loads(row[0])
-                track_data['played_at'] = row[1].isoformat() if hasattr(row[1], 'isoformat') else str(row[1])
-                history.append(track_data)
-            except:
-                continue
-        
-        return jsonify(history)
+        return jsonify(get_recent_listens(get_current_user_id()))
     except Exception as e:
         logger.error(f"Listening history error: {e}")
         return jsonify([])
 
+# Части главной страницы, которые считаются параллельно с основным запросом;
+# отдельный пул, потому что они сами отправляют запросы в upstream_executor
+dashboard_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='dashboard')
+DASHBOARD_TIMEOUT = 10
+
+def run_in_app_context(func, *args):
+    with app.app_context():
+        return func(*args)
+
+@app.route('/api/dashboard')
+@login_required
+def get_dashboard():
+    """Данные главной страницы одним запросом: статус токена, рекомендации, статистика и история"""
+    try:
+        user = get_current_user()
+        service = get_current_music_service(user.id)
+        
+        if service == 'yandex' and user.yandex_token:
+            token_status, token_ttl = check_token_status('yandex', user.yandex_token, validate_yandex_token)
+        elif service == 'vk' and user.vk_token:
+            token_status, token_ttl = check_token_status('vk', normalize_vk_token(user.vk_token), validate_vk_token)
+        else:
+            token_status, token_ttl = {'valid': False, 'message': 'Токен не настроен'}, 0
+        
+        dashboard = {
+            'service': service,
+            'token': {**token_status, 'cache_ttl': token_ttl},
+            'recommendations': [],
+            'stats': {},
+            'listening_history': get_recent_listens(user.id)
+        }
+        if not token_status['valid']:
+            return jsonify(dashboard)
+        
+        if service == 'yandex':
+            client = yandex_clients.get(user.yandex_token)
+            
+            # Лайки синхронизируются один раз: из зеркала читают и статистика, и рекомендации по лайкам
+            playlists_future = dashboard_executor.submit(run_in_app_context, sync_yandex_playlists, user.id, client)
+            try:
+                sync_yandex_likes(user.id, client)
+            except Exception as e:
+                logger.warning(f"Dashboard likes sync failed: {e}")
+            recommendations_future = dashboard_executor.submit(
+                run_in_app_context, recommender.get_recommendations, user.id, service
+            )
+            
+            try:
+                playlists_future.result(timeout=DASHBOARD_TIMEOUT)
+            except Exception as e:
+                logger.warning(f"Dashboard playlists sync failed: {e}")
+            dashboard['stats'] = get_yandex_stats(user.id)
+        
+        else:
+            recommendations_future = dashboard_executor.submit(
+                run_in_app_context, recommender.get_recommendations, user.id, service
+            )
+            try:
+                dashboard['stats'] = get_vk_stats(vk_clients.get(normalize_vk_token(user.vk_token))) or {}
+            except Exception as e:
+                logger.warning(f"Dashboard VK stats failed: {e}")
+        
+        try:
+            dashboard['recommendations'] = recommendations_future.result(timeout=DASHBOARD_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Dashboard recommendations failed: {e}")
+        
+        return jsonify(dashboard)
+    
+    except Exception as e:
+        logger.error(f"Dashboard error: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/daily_reward', methods=['POST'])
 @login_required
 def daily_reward():
     try:
         user_id = get_current_user_id()
-        db = get_db()
-        cursor = db.cursor()
         
         # Проверяем, получал ли пользователь награду сегодня
-        cursor.execute('''
+        rewarded_today = get_db().execute(db.text('''
             SELECT created_at FROM currency_transactions 
-            WHERE user_id = ? AND reason = 'daily_reward' 
-            AND date(created_at) = date('now')
-        ''', (user_id,))
+            WHERE user_id = :user_id AND reason = 'daily_reward' 
+            AND created_at >= :today
+            LIMIT 1
+        '''), {'user_id': user_id, 'today': datetime.utcnow().strftime('%Y-%m-%d')}).fetchone()
         
-        if cursor.fetchone():
+        if rewarded_today:
             return jsonify({'success': False, 'message': 'Вы уже получали награду сегодня'})
         
         # Добавляем награду
@@ -2448,6 +4176,29 @@ def internal_error(error):
 def not_found(error):
     return jsonify({'error': 'Not found'}), 404
 
+@app.route('/api/admin/ledger/reconcile', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def admin_reconcile_ledger():
+    """GET — показать расхождения балансов с журналом, POST — записать корректировки"""
+    try:
+        mismatches = reconcile_currency_ledger(fix=request.method == 'POST')
+        return jsonify({'success': True, 'mismatches': mismatches})
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Ledger reconcile error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@app.route('/api/admin/cache_stats')
+@login_required
+@admin_required
+def cache_stats():
+    return jsonify({
+        'yandex_clients': yandex_clients.stats(),
+        'vk_clients': vk_clients.stats(),
+        'listen_writer': listen_writer.stats()
+    })
+
 @app.route('/api/debug/tables')
 def debug_tables():
     try:
@@ -0,0 +1,17 @@
+# build_listen_rollups.py
+from app import app, update_listen_rollups
+
+def build_listen_rollups():
+    """Догнать счетчики прослушиваний до конца listening_history (для запуска по cron)"""
+    with app.app_context():
+        total = 0
+        while True:
+            processed = update_listen_rollups()
+            total += processed
+            if processed == 0:
+                break
+        
+        print(f"✅ Счетчики прослушиваний обновлены: обработано {total} записей")
+
+if __name__ == '__main__':
+    build_listen_rollups()
@@ -0,0 +1,79 @@
+# build_similarity_index.py
+from app import app, db, get_db
+import numpy as np
+from scipy import sparse
+
+def load_listens(conn):
+    """Уникальные пары (пользователь, трек) из истории прослушивания"""
+    rows = conn.execute(db.text('''
+        SELECT DISTINCT play_events.user_id, tracks.track_key FROM play_events
+        JOIN tracks ON tracks.id = play_events.track_id
+    ''')).fetchall()
+    user_ids = np.array([row[0] for row in rows])
+    track_ids = np.array([row[1] for row in rows], dtype=object)
+    return user_ids, track_ids
+
+def compute_similar_tracks(user_ids, track_ids, top_k=20, min_common_users=1):
+    """Косинусная близость треков по матрице трек x пользователь.
+    
+    Возвращает список (track_id, rank, similar_track_id, score).
+    """
+    if len(track_ids) == 0:
+        return []
+    
+    tracks, track_index = np.unique(track_ids.astype(str), return_inverse=True)
+    _, user_index = np.unique(user_ids, return_inverse=True)
+    
+    listens = sparse.csr_matrix(
+        (np.ones(len(track_index), dtype=np.float32), (track_index, user_index))
+    )
+    
+    # Число общих слушателей для каждой пары треков
+    co_occurrence = (listens @ listens.T).tocsr()
+    co_occurrence.setdiag(0)
+    co_occurrence.data[co_occurrence.data < min_common_users] = 0
+    co_occurrence.eliminate_zeros()
+    
+    inverse_norms = sparse.diags(1.0 / np.sqrt(listens.getnnz(axis=1)))
+    similarity = (inverse_norms @ co_occurrence @ inverse_norms).tocsr()
+    
+    rows = []
+    for i in range(similarity.shape[0]):
+        start, end = similarity.indptr[i], similarity.indptr[i + 1]
+        if start == end:
+            continue
+        
+        scores = similarity.data[start:end]
+        columns = similarity.indices[start:end]
+        if len(scores) > top_k:
+            best = np.argpartition(-scores, top_k)[:top_k]
+            scores, columns = scores[best], columns[best]
+        
+        order = np.argsort(-scores, kind='stable')
+        for rank, j in enumerate(order):
+            rows.append((tracks[i], rank, tracks[columns[j]], float(scores[j])))
+    
+    return rows
+
+def build_similarity_index(top_k=20, min_common_users=1):
+    with app.app_context():
+        conn = get_db()
+        
+        user_ids, track_ids = load_listens(conn)
+        rows = compute_similar_tracks(user_ids, track_ids, top_k, min_common_users)
+        
+        conn.execute(db.text('DELETE FROM track_similarity'))
+        if rows:
+            conn.execute(
+                db.text('INSERT INTO track_similarity (track_id, rank, similar_track_id, score) VALUES (:track_id, :rank, :similar_track_id, :score)'),
+                [
+                    {'track_id': track_id, 'rank': rank, 'similar_track_id': similar_track_id, 'score': score}
+                    for track_id, rank, similar_track_id, score in rows
+                ]
+            )
+        conn.commit()
+        
+        print(f"✅ Индекс похожих треков построен: {len(set(r[0] for r in rows))} треков, {len(rows)} связей")
+
+if __name__ == '__main__':
+    build_similarity_index()
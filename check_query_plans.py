@@ -0,0 +1,75 @@
+# check_query_plans.py
+import sys
+from app import app, db, get_db, IS_SQLITE
+
+# Горячие запросы приложения: (название, SQL, параметры)
+HOT_QUERIES = [
+    ('recent listens', '''
+        SELECT tracks.track_key, play_events.played_at FROM play_events
+        JOIN tracks ON tracks.id = play_events.track_id
+        WHERE play_events.user_id = :user_id
+        ORDER BY play_events.played_at DESC
+        LIMIT 10
+    ''', {'user_id': 1}),
+    ('user activity', '''
+        SELECT activity_type, activity_data, created_at FROM user_activity
+        WHERE user_id = :user_id
+        ORDER BY created_at DESC
+        LIMIT 20
+    ''', {'user_id': 1}),
+    ('friends list', '''
+        SELECT u.id, f.status FROM friends f
+        JOIN users u ON u.id = CASE WHEN f.user_id = :user_id THEN f.friend_id ELSE f.user_id END
+        WHERE (f.user_id = :user_id OR f.friend_id = :user_id)
+        AND f.status IN ('accepted', 'pending')
+    ''', {'user_id': 1}),
+    ('friend request lookup', '''
+        SELECT * FROM friends
+        WHERE (user_id = :user_id AND friend_id = :friend_id)
+        OR (user_id = :friend_id AND friend_id = :user_id)
+    ''', {'user_id': 1, 'friend_id': 2}),
+    ('top artists', '''
+        SELECT name, count FROM user_stat_counts
+        WHERE user_id = :user_id AND kind = 'artist'
+        ORDER BY count DESC
+        LIMIT 5
+    ''', {'user_id': 1}),
+    ('daily reward check', '''
+        SELECT created_at FROM currency_transactions
+        WHERE user_id = :user_id AND reason = 'daily_reward' AND created_at >= :since
+        LIMIT 1
+    ''', {'user_id': 1, 'since': '2024-01-01'}),
+    ('inventory item lookup', 'SELECT id FROM user_inventory WHERE user_id = :user_id AND item_id = :item_id', {'user_id': 1, 'item_id': 1}),
+    ('equipped items', 'SELECT item_id FROM user_inventory WHERE user_id = :user_id AND equipped = TRUE', {'user_id': 1}),
+]
+
+def full_scans(conn, query, params):
+    """Шаги плана запроса, которые читают таблицу целиком"""
+    if IS_SQLITE:
+        rows = conn.execute(db.text('EXPLAIN QUERY PLAN ' + query), params)
+        return [row[3] for row in rows if row[3].startswith('SCAN ')]
+    
+    # На маленьких таблицах PostgreSQL выбирает Seq Scan и при наличии индекса,
+    # поэтому запрещаем его: останется только там, где подходящего индекса нет
+    conn.execute(db.text('SET enable_seqscan = off'))
+    rows = conn.execute(db.text('EXPLAIN ' + query), params)
+    return [row[0].strip() for row in rows if 'Seq Scan' in row[0]]
+
+def check_query_plans():
+    """Проверить, что горячие запросы идут по индексам; возвращает список проваленных"""
+    with app.app_context():
+        conn = get_db()
+        
+        failed = []
+        for name, query, params in HOT_QUERIES:
+            scans = full_scans(conn, query, params)
+            if scans:
+                failed.append(name)
+                print(f"❌ {name}: {'; '.join(scans)}")
+            else:
+                print(f"✅ {name}")
+        
+        return failed
+
+if __name__ == '__main__':
+    sys.exit(1 if check_query_plans() else 0)
@@ -0,0 +1,21 @@
+# compact_currency_ledger.py
+import sys
+from app import app, compact_currency_ledger, reconcile_currency_ledger
+
+def maintain_currency_ledger(fix=False):
+    """Свернуть старые мелкие начисления и сверить балансы с журналом (для запуска по cron)"""
+    with app.app_context():
+        removed, created = compact_currency_ledger()
+        print(f"✅ Журнал валюты свернут: {removed} строк заменены на {created} итоговых")
+        
+        mismatches = reconcile_currency_ledger(fix=fix)
+        for mismatch in mismatches:
+            print(f"❌ Пользователь {mismatch['user_id']}: баланс {mismatch['balance']}, по журналу {mismatch['ledger']}")
+        if not mismatches:
+            print("✅ Балансы сходятся с журналом")
+        
+        return mismatches
+
+if __name__ == '__main__':
+    mismatches = maintain_currency_ledger(fix='--fix' in sys.argv)
+    sys.exit(1 if mismatches and '--fix' not in sys.argv else 0)
@@ -274,6 +274,7 @@ async function validateAndSaveToken(service, token) {
         const result = await response.json();
         
         if (result.success) {
+            sessionStorage.removeItem(`tokenStatus_${document.body.dataset.userId}_${service}`);
             showNotification(result.message, 'success');
             loadProfileData();
         } else {
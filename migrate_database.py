@@ -1,9 +1,49 @@
 # migrate_database.py
-from app import app, db
+from app import app, db, get_db, save_tracks, DATABASE, ID_COLUMN, IS_SQLITE
 from models import UserInventory, ShopItem
-import sqlite3
+from datetime import datetime
+import calendar
+import json
 import os
 
+LISTENING_HISTORY_BATCH_SIZE = 5000
+
+# Раньше сырые запросы шли в ./itired.db, а модели — в instance/itired.db
+LEGACY_DATABASE = 'itired.db'
+
+def merge_legacy_database(legacy_path=LEGACY_DATABASE):
+    """Перенести таблицы из старого файла базы в общий, если в общем они пустые"""
+    # ATTACH есть только в SQLite; в PostgreSQL старый файл переносится отдельно
+    if not IS_SQLITE or not os.path.exists(legacy_path) or os.path.abspath(legacy_path) == os.path.abspath(DATABASE):
+        print("Legacy database not found, nothing to merge")
+        return
+    
+    with app.app_context():
+        conn = get_db()
+        conn.execute(db.text('ATTACH DATABASE :path AS legacy'), {'path': legacy_path})
+        try:
+            tables = conn.execute(db.text(
+                "SELECT name FROM legacy.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+            )).fetchall()
+            for (table,) in tables:
+                main_columns = {row[0] for row in conn.execute(db.text('SELECT name FROM pragma_table_info(:table)'), {'table': table})}
+                if not main_columns:
+                    print(f"Skipping {table}: no such table in {DATABASE}")
+                    continue
+                
+                if conn.execute(db.text(f'SELECT 1 FROM main.{table} LIMIT 1')).fetchone():
+                    print(f"Skipping {table}: already has rows")
+                    continue
+                
+                legacy_columns = conn.execute(db.text('SELECT name FROM legacy.pragma_table_info(:table)'), {'table': table})
+                columns = ', '.join(row[0] for row in legacy_columns if row[0] in main_columns)
+                result = conn.execute(db.text(f'INSERT INTO main.{table} ({columns}) SELECT {columns} FROM legacy.{table}'))
+                print(f"Merged {table}: {result.rowcount} rows")
+            
+            conn.commit()
+        finally:
+            conn.execute(db.text('DETACH DATABASE legacy'))
+
 def migrate_database():
     with app.app_context():
         try:
@@ -34,12 +74,11 @@ def migrate_database():
             print(f"Error checking shop_items: {e}")
 
         try:
-            conn = sqlite3.connect('itired.db')
-            cursor = conn.cursor()
+            conn = get_db()
             
-            cursor.execute('''
+            conn.execute(db.text(f'''
                 CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    {ID_COLUMN},
                     username TEXT UNIQUE NOT NULL,
                     display_name TEXT,
                     email TEXT UNIQUE,
@@ -50,19 +89,107 @@ def migrate_database():
                     bio TEXT,
                     email_verified BOOLEAN DEFAULT FALSE,
                     verification_code TEXT,
-                    verification_code_expires DATETIME,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                    verification_code_expires TIMESTAMP,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
-            ''')
+            '''))
+            conn.commit()
             
-            print("SQLite tables checked/created successfully!")
+            print("Raw SQL tables checked/created successfully!")
             
         except Exception as e:
-            print(f"Error with SQLite tables: {e}")
-        finally:
-            if 'conn' in locals():
-                conn.close()
+            print(f"Error with raw SQL tables: {e}")
+
+def played_at_epoch(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return calendar.timegm(value.timetuple())
+
+def migrate_listening_history(batch_size=LISTENING_HISTORY_BATCH_SIZE):
+    """Перенести listening_history в tracks + play_events пачками.
+    
+    id событий сохраняются, прогресс хранится в rollup_state, поэтому миграцию
+    можно прервать и запустить снова.
+    """
+    with app.app_context():
+        conn = get_db()
+        
+        conn.execute(db.text(
+            "INSERT INTO rollup_state (name, last_id) VALUES ('listening_history_backfill', 0) ON CONFLICT (name) DO NOTHING"
+        ))
+        last_id = conn.execute(db.text("SELECT last_id FROM rollup_state WHERE name = 'listening_history_backfill'")).scalar()
+        
+        migrated = 0
+        while True:
+            rows = conn.execute(db.text('''
+                SELECT id, user_id, track_id, track_data, played_at FROM listening_history
+                WHERE id > :last_id
+                ORDER BY id
+                LIMIT :limit
+            '''), {'last_id': last_id, 'limit': batch_size}).fetchall()
+            if not rows:
+                break
+            
+            # Более поздние записи перезаписывают данные трека, в справочнике остаются последние
+            tracks = {}
+            events = []
+            for row_id, user_id, track_key, track_data, played_at in rows:
+                if not user_id or not track_key:
+                    continue
+                try:
+                    tracks[track_key] = json.loads(track_data) if track_data else {}
+                    events.append((row_id, user_id, track_key, played_at_epoch(played_at)))
+                except (TypeError, ValueError):
+                    print(f"Skipping listening_history row {row_id}: invalid data")
+            
+            track_ids = save_tracks(conn, tracks)
+            if events:
+                conn.execute(
+                    db.text('INSERT INTO play_events (id, user_id, track_id, played_at) VALUES (:id, :user_id, :track_id, :played_at) ON CONFLICT (id) DO NOTHING'),
+                    [
+                        {'id': row_id, 'user_id': user_id, 'track_id': track_ids[track_key], 'played_at': played}
+                        for row_id, user_id, track_key, played in events
+                    ]
+                )
+            
+            last_id = rows[-1][0]
+            conn.execute(
+                db.text("UPDATE rollup_state SET last_id = :last_id WHERE name = 'listening_history_backfill'"),
+                {'last_id': last_id}
+            )
+            conn.commit()
+            migrated += len(events)
+            print(f"Migrated {migrated} plays (listening_history id <= {last_id})")
+        
+        if migrated and not IS_SQLITE:
+            # Явные id не сдвигают последовательность PostgreSQL, иначе новые события упрутся в перенесенные
+            conn.execute(db.text(
+                "SELECT setval(pg_get_serial_sequence('play_events', 'id'), MAX(id)) FROM play_events HAVING MAX(id) IS NOT NULL"
+            ))
+            conn.commit()
+        
+        # Прослушивания в ленте активности теперь берутся из play_events
+        while True:
+            deleted = conn.execute(db.text('''
+                DELETE FROM user_activity WHERE id IN (
+                    SELECT id FROM user_activity WHERE activity_type = 'listen' LIMIT :limit
+                )
+            '''), {'limit': batch_size}).rowcount
+            conn.commit()
+            if deleted < batch_size:
+                break
+        
+        if migrated:
+            # Счетчики и статистика пересобираются по play_events, включая перенесенные события
+            conn.execute(db.text('DELETE FROM listen_rollups'))
+            conn.execute(db.text("UPDATE rollup_state SET last_id = 0 WHERE name = 'listens'"))
+            conn.execute(db.text('UPDATE user_stats SET recomputed_at = NULL'))
+            conn.commit()
+        
+        print(f"Listening history migration complete: {migrated} plays moved to play_events")
 
 if __name__ == '__main__':
-    migrate_database()
\ No newline at end of file
+    merge_legacy_database()
+    migrate_database()
+    migrate_listening_history()
\ No newline at end of file
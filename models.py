@@ -32,7 +32,7 @@ class User(db.Model):
     def get_current(cls):
         """Получить текущего авторизованного пользователя"""
         if 'user_id' in session:
-            return cls.query.get(session['user_id'])
+            return db.session.get(cls, session['user_id'])
         return None
 
     @classmethod
@@ -54,7 +54,7 @@ class User(db.Model):
 
     def get_inventory(self):
         """Получить инвентарь пользователя"""
-        return UserInventory.query.filter_by(user_id=self.id).all()
+        return UserInventory.query.options(db.joinedload(UserInventory.item)).filter_by(user_id=self.id).all()
 
 class UserCurrency(db.Model):
     __tablename__ = 'user_currency'
@@ -99,6 +99,10 @@ class ShopItem(db.Model):
 
 class UserInventory(db.Model):
     __tablename__ = 'user_inventory'
+    __table_args__ = (
+        db.Index('uq_user_inventory_user_item', 'user_id', 'item_id', unique=True),
+        db.Index('idx_user_inventory_user_equipped', 'user_id', 'equipped'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -108,10 +112,15 @@ class UserInventory(db.Model):
 
 class CurrencyTransaction(db.Model):
     __tablename__ = 'currency_transactions'
+    __table_args__ = (
+        db.Index('idx_currency_transactions_user_reason_created', 'user_id', 'reason', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     amount = db.Column(db.Integer, nullable=False)
     reason = db.Column(db.String(200), nullable=False)
+    # Сколько начислений объединено в строке (см. compact_currency_ledger)
+    entries = db.Column(db.Integer, default=1)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -1,15 +1,26 @@
 # recreate_database.py
-from app import app, db
+from app import app, db, get_db, DATABASE, ID_COLUMN, IS_SQLITE
 from models import User, UserCurrency, ShopCategory, ShopItem, UserInventory, CurrencyTransaction
 import os
 import bcrypt
-import sqlite3
 
 def recreate_database():
     print("🔄 Полная пересоздание базы данных...")
     
-    if os.path.exists('itired.db'):
-        os.remove('itired.db')
+    # Пул держит открытые соединения к файлу — закрываем их до удаления
+    with app.app_context():
+        if not IS_SQLITE:
+            # В PostgreSQL удаляем все таблицы, включая созданные сырым SQL
+            metadata = db.MetaData()
+            metadata.reflect(bind=db.engine)
+            metadata.drop_all(bind=db.engine)
+            print("🗑️ Старые таблицы удалены")
+        db.engine.dispose()
+    
+    if IS_SQLITE and os.path.exists(DATABASE):
+        for path in (DATABASE, f'{DATABASE}-wal', f'{DATABASE}-shm'):
+            if os.path.exists(path):
+                os.remove(path)
         print("🗑️ Старая база данных удалена")
     
     with app.app_context():
@@ -24,14 +35,13 @@ def recreate_database():
         print("🎉 База данных полностью пересоздана!")
 
 def create_sqlite_tables():
-    """Создаем стандартные таблицы SQLite"""
+    """Создаем стандартные таблицы сырого SQL"""
     try:
-        conn = sqlite3.connect('itired.db')
-        cursor = conn.cursor()
+        conn = get_db()
         
-        cursor.execute('''
+        conn.execute(db.text(f'''
             CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {ID_COLUMN},
                 username TEXT UNIQUE NOT NULL,
                 display_name TEXT,
                 email TEXT UNIQUE,
@@ -42,14 +52,14 @@ def create_sqlite_tables():
                 bio TEXT,
                 email_verified BOOLEAN DEFAULT FALSE,
                 verification_code TEXT,
-                verification_code_expires DATETIME,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                verification_code_expires TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
-        ''')
+        '''))
         
         # Таблица настроек
-        cursor.execute('''
+        conn.execute(db.text('''
             CREATE TABLE IF NOT EXISTS user_settings (
                 user_id INTEGER PRIMARY KEY,
                 theme TEXT DEFAULT 'dark',
@@ -59,67 +69,66 @@ def create_sqlite_tables():
                 music_service TEXT DEFAULT 'yandex',
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
-        ''')
+        '''))
         
         # Таблица активности
-        cursor.execute('''
+        conn.execute(db.text(f'''
             CREATE TABLE IF NOT EXISTS user_activity (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {ID_COLUMN},
                 user_id INTEGER,
                 activity_type TEXT NOT NULL,
                 activity_data TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
-        ''')
+        '''))
         
         # Таблица друзей
-        cursor.execute('''
+        conn.execute(db.text(f'''
             CREATE TABLE IF NOT EXISTS friends (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {ID_COLUMN},
                 user_id INTEGER,
                 friend_id INTEGER,
                 status TEXT DEFAULT 'pending',
                 taste_match INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id),
                 FOREIGN KEY (friend_id) REFERENCES users (id),
                 UNIQUE(user_id, friend_id)
             )
-        ''')
+        '''))
         
         # История прослушивания
-        cursor.execute('''
+        conn.execute(db.text(f'''
             CREATE TABLE IF NOT EXISTS listening_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {ID_COLUMN},
                 user_id INTEGER,
                 track_id TEXT,
                 track_data TEXT,
-                played_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                played_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
-        ''')
+        '''))
         
         # Пользовательские темы
-        cursor.execute('''
+        conn.execute(db.text(f'''
             CREATE TABLE IF NOT EXISTS user_themes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                {ID_COLUMN},
                 user_id INTEGER,
                 name TEXT NOT NULL,
                 colors TEXT NOT NULL,
                 background_url TEXT,
                 is_default BOOLEAN DEFAULT FALSE,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (user_id) REFERENCES users (id)
             )
-        ''')
+        '''))
         
         conn.commit()
-        conn.close()
-        print("✅ Стандартные SQLite таблицы созданы")
+        print("✅ Стандартные таблицы сырого SQL созданы")
         
     except Exception as e:
-        print(f"❌ Ошибка создания SQLite таблиц: {e}")
+        print(f"❌ Ошибка создания таблиц сырого SQL: {e}")
 
 def init_shop_data():
     """Инициализация данных магазина"""
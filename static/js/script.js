@@ -531,24 +531,55 @@ async function checkAuth() {
   }
 }
 
-async function checkYandexToken() {
+// Результат проверки токена хранится в sessionStorage столько, сколько разрешил сервер (cache_ttl);
+// profile.js удаляет запись после сохранения нового токена. В ключе есть id пользователя:
+// sessionStorage вкладки переживает выход и вход под другим аккаунтом
+const TOKEN_STATUS_KEY = "tokenStatus_";
+
+function tokenStatusKey(service) {
+  return TOKEN_STATUS_KEY + document.body.dataset.userId + "_" + service;
+}
+
+async function checkTokenStatus(service) {
+  const key = tokenStatusKey(service);
   try {
-    const response = await apiCall("check_yandex_token");
-    return response;
+    const cached = JSON.parse(sessionStorage.getItem(key));
+    if (cached && cached.expiresAt > Date.now()) {
+      return cached.status;
+    }
   } catch (error) {
-    return { valid: false, message: "Ошибка проверки токена" };
+    sessionStorage.removeItem(key);
   }
-}
 
-async function checkVkToken() {
   try {
-    const response = await apiCall("check_vk_token");
+    const response = await apiCall(`check_${service}_token`, { cache: "no-store" });
+    rememberTokenStatus(service, response);
     return response;
   } catch (error) {
     return { valid: false, message: "Ошибка проверки токена" };
   }
 }
 
+function rememberTokenStatus(service, status) {
+  if (status && status.cache_ttl) {
+    sessionStorage.setItem(
+      tokenStatusKey(service),
+      JSON.stringify({
+        status: status,
+        expiresAt: Date.now() + status.cache_ttl * 1000,
+      })
+    );
+  }
+}
+
+async function checkYandexToken() {
+  return checkTokenStatus("yandex");
+}
+
+async function checkVkToken() {
+  return checkTokenStatus("vk");
+}
+
 async function loadProfile() {
   try {
     const profile = await apiCall("profile");
@@ -609,31 +640,20 @@ function updateHeaderProfile(profile) {
 
 async function loadDashboard() {
   try {
-    let tokenStatus;
-    if (currentService === "yandex") {
-      tokenStatus = await checkYandexToken();
-    } else {
-      tokenStatus = await checkVkToken();
-    }
+    // Статус токена, рекомендации, статистика и история приходят одним запросом
+    const dashboard = await apiCall("dashboard");
+    rememberTokenStatus(dashboard.service, dashboard.token);
 
-    if (!tokenStatus.valid) {
+    if (!dashboard.token.valid) {
       displayRecommendations([]);
       displayRecentTracks([]);
       updateWelcomeStats({ total_liked_tracks: 0, total_playlists: 0 });
       return;
     }
 
-    const [recommendations, likedTracks, stats, listeningHistory] =
-      await Promise.all([
-        apiCall("recommendations").catch(() => []),
-        apiCall("liked_tracks").catch(() => []),
-        apiCall("stats").catch(() => ({})),
-        apiCall("listening_history").catch(() => []),
-      ]);
-
-    displayRecommendations(recommendations);
-    displayRecentTracks(listeningHistory);
-    updateWelcomeStats(stats);
+    displayRecommendations(dashboard.recommendations);
+    displayRecentTracks(dashboard.listening_history);
+    updateWelcomeStats(dashboard.stats);
   } catch (error) {
     console.error("Error loading dashboard:", error);
   }
@@ -824,6 +844,11 @@ async function loadPlaylists() {
   }
 }
 
+const LIKED_PAGE_SIZE = 50;
+let likedCursor = null;
+let likedLoading = false;
+let likedObserver = null;
+
 async function loadLikedTracks() {
   try {
     let tokenStatus;
@@ -841,69 +866,127 @@ async function loadLikedTracks() {
       return;
     }
 
-    const tracks = await apiCall("liked_tracks");
-    currentPlaylist = tracks;
+    const container = document.getElementById("likedTracks");
+    if (container) container.innerHTML = "";
+    currentPlaylist = [];
+    likedCursor = null;
+
+    await loadMoreLikedTracks(true);
+  } catch (error) {
+    const container = document.getElementById("likedTracks");
+    if (container) {
+      container.innerHTML =
+        '<div class="error">Ошибка загрузки лайкнутых треков</div>';
+    }
+  }
+}
+
+async function loadMoreLikedTracks(firstPage = false) {
+  if (likedLoading || (!firstPage && !likedCursor)) return;
+  likedLoading = true;
+
+  try {
+    let endpoint = "liked_tracks?limit=" + LIKED_PAGE_SIZE;
+    if (likedCursor) endpoint += "&cursor=" + encodeURIComponent(likedCursor);
 
+    const page = await apiCall(endpoint);
     const likedCount = document.getElementById("likedCount");
     const container = document.getElementById("likedTracks");
 
-    if (likedCount) likedCount.textContent = tracks.length + " треков";
+    if (page.reset) {
+      currentPlaylist = [];
+      if (container) container.innerHTML = "";
+    }
+
+    currentPlaylist = currentPlaylist.concat(page.tracks);
+    likedCursor = page.next_cursor;
+
+    if (likedCount) likedCount.textContent = page.total + " треков";
 
     if (container) {
-      if (!tracks || tracks.length === 0) {
+      if (currentPlaylist.length === 0) {
         container.innerHTML = '<div class="error">Нет лайкнутых треков</div>';
         return;
       }
 
       let html = "";
-      tracks.forEach(function (track, index) {
-        html += '<div class="track-item" data-track-id="' + track.id + '">';
-        if (track.cover_uri) {
-          html +=
-            '<img src="' +
-            track.cover_uri +
-            '" alt="' +
-            track.title +
-            '" class="track-cover">';
-        } else {
-          html +=
-            '<div class="track-cover" style="background:#333;display:flex;align-items:center;justify-content:center">';
-          html += '<i class="fas fa-music" style="color:#666"></i>';
-          html += "</div>";
-        }
-        html += '<div class="track-info">';
-        html += "<h4>" + track.title + "</h4>";
-        html +=
-          "<p>" +
-          (track.artists ? track.artists.join(", ") : "") +
-          " • " +
-          (track.album || "") +
-          " • " +
-          (track.year || "") +
-          "</p>";
-        html += "</div>";
-        html +=
-          '<span class="track-duration">' +
-          formatDuration(track.duration) +
-          "</span>";
-        html +=
-          '<span class="service-badge ' +
-          track.service +
-          '">' +
-          (track.service === "yandex" ? "Y" : "VK") +
-          "</span>";
-        html += "</div>";
+      page.tracks.forEach(function (track) {
+        html += renderLikedTrack(track);
       });
 
-      container.innerHTML = html;
-    }
-  } catch (error) {
-    const container = document.getElementById("likedTracks");
-    if (container) {
-      container.innerHTML =
-        '<div class="error">Ошибка загрузки лайкнутых треков</div>';
+      const sentinel = document.getElementById("likedTracksSentinel");
+      if (sentinel) sentinel.remove();
+      container.insertAdjacentHTML("beforeend", html);
+
+      if (likedCursor) {
+        container.insertAdjacentHTML(
+          "beforeend",
+          '<div id="likedTracksSentinel" class="loading">Загрузка...</div>'
+        );
+        observeLikedSentinel();
+      }
     }
+  } finally {
+    likedLoading = false;
+  }
+}
+
+function observeLikedSentinel() {
+  const sentinel = document.getElementById("likedTracksSentinel");
+  if (!sentinel) return;
+
+  if (!likedObserver) {
+    likedObserver = new IntersectionObserver(function (entries) {
+      if (entries.some((entry) => entry.isIntersecting)) {
+        loadMoreLikedTracks().catch((error) => {
+          console.error("Error loading liked tracks page:", error);
+        });
+      }
+    });
+  }
+
+  likedObserver.disconnect();
+  likedObserver.observe(sentinel);
+}
+
+function renderLikedTrack(track) {
+  let html = '<div class="track-item" data-track-id="' + track.id + '">';
+  if (track.cover_uri) {
+    html +=
+      '<img src="' +
+      track.cover_uri +
+      '" alt="' +
+      track.title +
+      '" class="track-cover">';
+  } else {
+    html +=
+      '<div class="track-cover" style="background:#333;display:flex;align-items:center;justify-content:center">';
+    html += '<i class="fas fa-music" style="color:#666"></i>';
+    html += "</div>";
   }
+  html += '<div class="track-info">';
+  html += "<h4>" + track.title + "</h4>";
+  html +=
+    "<p>" +
+    (track.artists ? track.artists.join(", ") : "") +
+    " • " +
+    (track.album || "") +
+    " • " +
+    (track.year || "") +
+    "</p>";
+  html += "</div>";
+  html +=
+    '<span class="track-duration">' +
+    formatDuration(track.duration) +
+    "</span>";
+  html +=
+    '<span class="service-badge ' +
+    track.service +
+    '">' +
+    (track.service === "yandex" ? "Y" : "VK") +
+    "</span>";
+  html += "</div>";
+  return html;
 }
 
 async function loadStats() {
@@ -1229,7 +1312,20 @@ async function playTrack(trackId) {
       return;
     }
 
-    const trackData = await apiCall("play_track/" + service + "_" + id);
+    // Ссылка уже получена заранее — запускаем сразу, запрос play_track только записывает прослушивание
+    const prefetched = prefetchedTracks[trackId];
+    delete prefetchedTracks[trackId];
+
+    let trackData;
+    if (prefetched && Date.now() - prefetched.fetchedAt < PREFETCH_MAX_AGE_MS) {
+      trackData = prefetched.track;
+      apiCall("play_track/" + service + "_" + id).catch((error) => {
+        console.error("Error logging listen:", error);
+      });
+    } else {
+      trackData = await apiCall("play_track/" + service + "_" + id);
+    }
+
     if (trackData.url) {
       audioPlayer.pause();
       audioPlayer.src = trackData.url;
@@ -1248,6 +1344,8 @@ async function playTrack(trackId) {
           (track) => track.id === trackId
         );
       }
+
+      prefetchUpcomingTracks();
     }
   } catch (error) {
     console.error("Error playing track:", error);
@@ -1255,6 +1353,58 @@ async function playTrack(trackId) {
   }
 }
 
+const PREFETCH_COUNT = 3;
+const PREFETCH_MAX_AGE_MS = 5 * 60 * 1000;
+let prefetchedTracks = {};
+let preloadAudio = null;
+
+function getUpcomingTrackIds(count) {
+  if (typeof playbackQueue !== "undefined" && playbackQueue.length > 0) {
+    return playbackQueue.slice(0, count).map((track) => track.id);
+  }
+
+  const ids = [];
+  if (currentPlaylist.length > 0 && !isShuffle) {
+    for (let i = 1; i <= count && i < currentPlaylist.length; i++) {
+      ids.push(currentPlaylist[(currentTrackIndex + i) % currentPlaylist.length].id);
+    }
+  }
+  return ids;
+}
+
+async function prefetchUpcomingTracks() {
+  const trackIds = getUpcomingTrackIds(PREFETCH_COUNT).filter(
+    (trackId) =>
+      !prefetchedTracks[trackId] ||
+      Date.now() - prefetchedTracks[trackId].fetchedAt >= PREFETCH_MAX_AGE_MS
+  );
+  if (trackIds.length === 0) return;
+
+  try {
+    const result = await apiCall("prefetch_tracks", {
+      method: "POST",
+      body: JSON.stringify({ track_ids: trackIds }),
+    });
+
+    const fetchedAt = Date.now();
+    Object.entries(result.tracks).forEach(function ([trackId, track]) {
+      prefetchedTracks[trackId] = { track: track, fetchedAt: fetchedAt };
+    });
+
+    // Браузер начинает буферизовать следующий трек заранее
+    const upcoming = result.tracks[trackIds[0]];
+    if (upcoming && upcoming.url) {
+      if (!preloadAudio) {
+        preloadAudio = new Audio();
+        preloadAudio.preload = "auto";
+      }
+      preloadAudio.src = upcoming.url;
+    }
+  } catch (error) {
+    console.error("Error prefetching tracks:", error);
+  }
+}
+
 function updatePlayerUI(trackData) {
   document.getElementById("currentTrack").textContent = trackData.title;
   document.getElementById("currentArtist").textContent =
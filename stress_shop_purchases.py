@@ -0,0 +1,136 @@
+# stress_shop_purchases.py
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# Без DATABASE_URL прогон идет во временной базе, чтобы прерванный запуск не оставлял
+# строки в instance/itired.db; заданный DATABASE_URL (например, PostgreSQL) используется как есть
+if not os.getenv('DATABASE_URL'):
+    TEMP_DIR = tempfile.mkdtemp(prefix='stress_shop_')
+    atexit.register(shutil.rmtree, TEMP_DIR, ignore_errors=True)
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(TEMP_DIR, 'itired.db')}"
+
+from app import app, add_currency, write_listens
+from models import db, User, UserCurrency, ShopCategory, ShopItem, UserInventory, CurrencyTransaction
+
+# Параллельные покупки с фиксированного баланса: хватает ровно на BALANCE // PRICE предметов,
+# а каждый предмет запрашивается несколькими потоками сразу. Вперемешку с покупками тот же
+# баланс пополняют начисления по 1 монете: через write_listens и через add_currency
+THREADS = 16
+ITEMS = 20
+ATTEMPTS_PER_ITEM = 10
+PRICE = 10
+BALANCE = 100
+CREDITS = 40
+
+def create_fixture():
+    """Временный пользователь с балансом, записанным и в журнал, и временные предметы"""
+    suffix = uuid.uuid4().hex[:8]
+    user = User(username=f'stress_{suffix}', email=f'stress_{suffix}@itired.local', password_hash='-')
+    category = ShopCategory(name=f'stress_{suffix}', description='Нагрузочная проверка покупок')
+    db.session.add_all([user, category])
+    db.session.flush()
+    
+    items = [
+        ShopItem(name=f'stress_{suffix}_{i}', type='stress', category_id=category.id, price=PRICE)
+        for i in range(ITEMS)
+    ]
+    db.session.add_all(items)
+    db.session.add(UserCurrency(user_id=user.id, balance=BALANCE))
+    db.session.add(CurrencyTransaction(user_id=user.id, amount=BALANCE, reason='stress_seed'))
+    db.session.commit()
+    return user.id, category.id, [item.id for item in items]
+
+def remove_fixture(user_id, category_id, item_ids):
+    db.session.execute(db.text('DELETE FROM play_events WHERE user_id = :user_id'), {'user_id': user_id})
+    db.session.execute(db.text('DELETE FROM tracks WHERE track_key LIKE :prefix'), {'prefix': f'yandex_stress_{user_id}_%'})
+    UserInventory.query.filter(UserInventory.item_id.in_(item_ids)).delete(synchronize_session=False)
+    CurrencyTransaction.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    UserCurrency.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+    ShopItem.query.filter(ShopItem.id.in_(item_ids)).delete(synchronize_session=False)
+    ShopCategory.query.filter_by(id=category_id).delete(synchronize_session=False)
+    User.query.filter_by(id=user_id).delete(synchronize_session=False)
+    db.session.commit()
+
+def buy(user_id, item_id):
+    """Покупка через API отдельным клиентом, как из браузера"""
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = user_id
+    response = client.post(f'/api/shop/buy/{item_id}')
+    return response.status_code, (response.get_json() or {}).get('success', False)
+
+def credit(user_id, n):
+    """Начислить 1 монету: четные — наградой за прослушивание, нечетные — через add_currency"""
+    with app.app_context():
+        if n % 2:
+            add_currency(user_id, 1, 'stress_credit')
+        else:
+            write_listens([(user_id, 'yandex', f'stress_{user_id}_{n}', {'title': f'stress {n}'}, int(time.time()))])
+
+def check_results(user_id, item_ids, responses):
+    """Инварианты после гонки; возвращает список проваленных проверок"""
+    db.session.expire_all()
+    balances = [balance for (balance,) in db.session.query(UserCurrency.balance).filter_by(user_id=user_id)]
+    balance = sum(balances)
+    ledger = db.session.query(db.func.coalesce(db.func.sum(CurrencyTransaction.amount), 0)).filter_by(user_id=user_id).scalar()
+    owned = db.session.query(UserInventory.item_id).filter_by(user_id=user_id).all()
+    bought = sum(1 for status, success in responses if success)
+    errors = [status for status, success in responses if status >= 500]
+    # Сколько предметов куплено сверх стартового баланса, зависит от того, когда пришли начисления
+    max_bought = min((BALANCE + CREDITS) // PRICE, len(item_ids))
+    
+    checks = [
+        ('no server errors', not errors, f'{len(errors)} responses with 5xx'),
+        ('single balance row', len(balances) == 1, balances),
+        ('balance is not negative', balance >= 0, balance),
+        ('no duplicate inventory rows', len(owned) == len(set(owned)), len(owned) - len(set(owned))),
+        ('balance equals ledger sum', balance == ledger, f'{balance} != {ledger}'),
+        ('every success is one inventory row', bought == len(owned), f'{bought} != {len(owned)}'),
+        ('no credit or purchase lost', balance == BALANCE + CREDITS - bought * PRICE, f'{balance} != {BALANCE + CREDITS - bought * PRICE}'),
+        ('balance spent down', BALANCE // PRICE <= bought <= max_bought, bought),
+    ]
+    
+    failed = []
+    for name, ok, details in checks:
+        if ok:
+            print(f"✅ {name}")
+        else:
+            failed.append(name)
+            print(f"❌ {name}: {details}")
+    return failed
+
+def stress_shop_purchases(threads=THREADS):
+    """Параллельно купить предметы и пополнить баланс, затем проверить, что баланс сходится"""
+    with app.app_context():
+        user_id, category_id, item_ids = create_fixture()
+        try:
+            attempts = [item_id for item_id in item_ids for _ in range(ATTEMPTS_PER_ITEM)]
+            # Начисления равномерно вперемешку с покупками, чтобы они шли одновременно
+            step = len(attempts) // CREDITS
+            jobs = []
+            for n, item_id in enumerate(attempts):
+                jobs.append(('buy', item_id))
+                if n % step == 0 and n // step < CREDITS:
+                    jobs.append(('credit', n // step))
+            
+            def run(job):
+                kind, arg = job
+                return buy(user_id, arg) if kind == 'buy' else credit(user_id, arg)
+            
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                results = list(executor.map(run, jobs))
+            responses = [result for (kind, _), result in zip(jobs, results) if kind == 'buy']
+            print(f"{len(attempts)} покупок и {CREDITS} начислений в {threads} потоков, успешных покупок: {sum(1 for status, success in responses if success)}")
+            return check_results(user_id, item_ids, responses)
+        finally:
+            remove_fixture(user_id, category_id, item_ids)
+
+if __name__ == '__main__':
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else THREADS
+    sys.exit(1 if stress_shop_purchases(threads) else 0)